@@ -0,0 +1,17 @@
+""" Benchmarks for fsmcontainers.
+
+The suites in the ``bench_*`` modules follow the conventions of airspeed
+velocity (asv), so asv can run them, but they need nothing beyond the
+standard library, fsmcontainers and its own dependencies, and run offline
+with::
+
+    python -m benchmarks.run
+
+which runs every benchmark in a process of its own and reports its time,
+the peak resident set size of the process and, for suites run over
+lexicons of several sizes, how the time scales with the size. Pass
+``--max-size 10000`` for a quick run, or ``-k`` to pick benchmarks by name.
+
+Lexicons are made up by :mod:`benchmarks.lexicon`, and the end-to-end Pig
+Latin benchmark reads the word list bundled in ``benchmarks/data``.
+"""
@@ -0,0 +1,180 @@
+""" Benchmarks for the container hot paths, in the style of airspeed
+velocity (asv): ``setup`` runs first, then each ``time_`` method is timed
+and each ``peakmem_`` method has the peak memory of its process measured.
+Most suites are run over lexicons of 10^3 to 10^6 words, to show how costs
+scale. Run them with ``python -m benchmarks.run``. """
+
+import functools
+import operator
+from fsmcontainers.fsmcontainers import fsa, fst, cascade
+from fsmcontainers.rules import compile_rules
+from .lexicon import words, pairs
+
+SIZES = [10**3, 10**4, 10**5, 10**6]
+
+# The dictionaries that the constructors build, and machines built by Pynini
+# from sorted input, which are composed and compared as automata.
+ENGINES = ["dict", "pynini"]
+
+def _build(cls, items, engine):
+    if engine == "dict":
+        return cls(items)
+    return cls.from_sorted(sorted(items))
+
+def _forget(container):
+    """ Drop the path count and fingerprint that the machine of *container*
+    keeps once worked out, so that timing them again works them out
+    again. """
+    for name in ("pathCount", "canonicalForm", "digest"):
+        if hasattr(container.fsm, name):
+            setattr(container.fsm, name, None)
+
+
+class Construction(object):
+    params = SIZES
+    param_names = ["words"]
+    timeout = 1800
+
+    def setup(self, n):
+        self.words = words(n)
+        self.sortedWords = sorted(self.words)
+        self.pairs = pairs(n)
+
+    def time_fsa(self, n):
+        fsa(self.words)
+
+    def time_fst(self, n):
+        fst(self.pairs)
+
+    def time_fsa_from_sorted(self, n):
+        fsa.from_sorted(self.sortedWords)
+
+    def peakmem_fst(self, n):
+        fst(self.pairs)
+
+    def peakmem_fsa_from_sorted(self, n):
+        fsa.from_sorted(self.sortedWords)
+
+
+class Lookup(object):
+    params = [SIZES, ["dict", "frozen"]]
+    param_names = ["words", "engine"]
+    timeout = 1800
+
+    def setup(self, n, engine):
+        if engine == "frozen":
+            self.map = fst.from_sorted(sorted(pairs(n))).freeze()
+        else:
+            self.map = fst(pairs(n))
+        # A thousand keys that are there and a thousand that aren't.
+        self.hits = words(n)[:1000]
+        self.keys = self.hits + [word + "q" for word in self.hits]
+
+    def time_getitem(self, n, engine):
+        for key in self.hits:
+            self.map[key]
+
+    def time_contains(self, n, engine):
+        for key in self.keys:
+            key in self.map
+
+    def time_lookup_many(self, n, engine):
+        self.map.lookup_many(self.keys)
+
+    def time_contains_many(self, n, engine):
+        self.map.contains_many(self.keys)
+
+
+class Comparison(object):
+    params = [SIZES, ENGINES]
+    param_names = ["words", "engine"]
+    timeout = 1800
+
+    def setup(self, n, engine):
+        self.pairs = pairs(n)
+        self.map = _build(fst, self.pairs, engine)
+        self.same = _build(fst, list(reversed(self.pairs)), engine)
+        self.dict = dict(self.pairs)
+
+    def time_len(self, n, engine):
+        _forget(self.map)
+        len(self.map)
+
+    def time_eq(self, n, engine):
+        # Pynini machines are compared by fingerprint, which is kept once
+        # worked out.
+        _forget(self.map)
+        _forget(self.same)
+        self.map == self.same
+
+    def time_eq_dict(self, n, engine):
+        _forget(self.map)
+        self.map == self.dict
+
+
+class UnionFolding(object):
+    params = [SIZES, ENGINES]
+    param_names = ["words", "engine"]
+    timeout = 1800
+
+    def setup(self, n, engine):
+        items = words(n)
+        size = max(n // 100, 1)
+        self.parts = [_build(fsa, items[i:i + size], engine)
+                      for i in range(0, n, size)]
+
+    def time_union(self, n, engine):
+        self.parts[0].union(self.parts[1:])
+
+    def time_or_chain(self, n, engine):
+        functools.reduce(operator.or_, self.parts)
+
+    def peakmem_union(self, n, engine):
+        self.parts[0].union(self.parts[1:])
+
+
+class Cascade(object):
+    params = [SIZES, ENGINES]
+    param_names = ["words", "engine"]
+    timeout = 1800
+
+    def setup(self, n, engine):
+        items = pairs(n)
+        self.stages = [
+            _build(fst, items, engine),
+            _build(fst, [(v, v.upper()) for _, v in items], engine),
+            _build(fst, [(v.upper(), str(len(v))) for _, v in items], engine)]
+        self.cascade = cascade(*self.stages)
+        self.keys = [k for k, _ in items[:1000]]
+
+    def time_lookup_many(self, n, engine):
+        self.cascade.lookup_many(self.keys)
+
+    def time_getitem(self, n, engine):
+        for key in self.keys:
+            self.cascade[key]
+
+    def time_compose(self, n, engine):
+        self.stages[0].compose(*self.stages[1:])
+
+
+class RuleCompilation(object):
+    params = [10, 30, 100, 300]
+    param_names = ["rule pairs"]
+    timeout = 1800
+
+    def setup(self, n):
+        items = words(n)
+        self.rule = fst((w, w.upper()) for w in items)
+        # The same pairs again, as a grammar of rules of ten pairs each.
+        self.specs = [(fst((w, w.upper()) for w in items[i:i + 10]), "a", "e")
+                      for i in range(0, n, 10)]
+
+    def time_between(self, n):
+        self.rule.between("a", "e")
+
+    def time_compile_rules(self, n):
+        compile_rules(self.specs, max_workers=1)
+
+    def peakmem_between(self, n):
+        self.rule.between("a", "e")
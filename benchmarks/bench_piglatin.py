@@ -0,0 +1,38 @@
+""" End-to-end benchmark: build the Pig Latin translator in
+``sphinx-test/piglatin.py`` from the synthetic word list bundled in
+``benchmarks/data``, with an empty compile cache each time. """
+
+import contextlib
+import io
+import os
+import runpy
+import shutil
+import tempfile
+from .lexicon import WORDS
+
+PIGLATIN = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                        "sphinx-test", "piglatin.py")
+
+
+class Piglatin(object):
+    timeout = 1800
+
+    def setup(self):
+        self.cache = tempfile.mkdtemp(prefix="fsmcontainers-bench-")
+        os.environ["PIGLATIN_WORDS"] = WORDS
+        os.environ["FSMCONTAINERS_CACHE"] = self.cache
+
+    def teardown(self):
+        shutil.rmtree(self.cache, ignore_errors=True)
+
+    def _build(self):
+        for entry in os.scandir(self.cache):
+            os.remove(entry.path) # Build from scratch every time.
+        with contextlib.redirect_stdout(io.StringIO()):
+            runpy.run_path(PIGLATIN)
+
+    def time_build(self):
+        self._build()
+
+    def peakmem_build(self):
+        self._build()
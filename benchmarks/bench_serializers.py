@@ -0,0 +1,70 @@
+""" Benchmarks for the key and value serializers, in the style of airspeed
+velocity (asv): each ``time_`` method is timed after ``setup`` has run.
+Run ``python -m benchmarks.bench_serializers`` to print the cost per item
+of each one without installing asv. """
+
+import timeit
+from fsmcontainers.serializers import Serializer
+from .lexicon import words
+
+
+class StringSerializerSuite(object):
+    params = [1000, 100000]
+    param_names = ["items"]
+
+    def setup(self, n):
+        self.serializer = Serializer.from_prototype("")
+        self.words = words(n)
+
+    def time_serialize(self, n):
+        serialize = self.serializer.serialize
+        for word in self.words:
+            serialize(word)
+
+    def time_serialize_many(self, n):
+        self.serializer.serialize_many(self.words)
+
+
+class TupleSerializerSuite(object):
+    params = [1000, 100000]
+    param_names = ["items"]
+
+    def setup(self, n):
+        self.serializer = Serializer.from_prototype(("", ""))
+        items = words(n)
+        self.pairs = list(zip(items, reversed(items)))
+        self.strings = self.serializer.serialize_many(self.pairs)
+        # Lookups inflate the same few paths over and over.
+        self.repeated = self.strings[:100] * (n // 100)
+
+    def time_serialize(self, n):
+        serialize = self.serializer.serialize
+        for pair in self.pairs:
+            serialize(pair)
+
+    def time_serialize_many(self, n):
+        self.serializer.serialize_many(self.pairs)
+
+    def time_inflate_many(self, n):
+        self.serializer.inflate.cache_clear()
+        self.serializer.inflate_many(self.strings)
+
+    def time_inflate_many_repeated(self, n):
+        self.serializer.inflate.cache_clear()
+        self.serializer.inflate_many(self.repeated)
+
+
+def main(n=100000, repeat=5):
+    for suite in (StringSerializerSuite, TupleSerializerSuite):
+        bench = suite()
+        bench.setup(n)
+        for name in sorted(dir(bench)):
+            if name.startswith("time_"):
+                method = getattr(bench, name)
+                best = min(timeit.repeat(lambda: method(n), number=1,
+                                         repeat=repeat))
+                print("%s.%s: %.0f ns per item"
+                      % (suite.__name__, name, best / n * 1e9))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+""" Synthetic lexicons for the benchmarks, so that they run the same way on
+any machine without a system word list. Words are made of English-like
+syllables, so they have the onsets, lengths and shared prefixes of real
+words. Run this module to regenerate the bundled word list::
+
+    python -m benchmarks.lexicon 10000 > benchmarks/data/words.txt
+"""
+
+import functools
+import os
+import random
+import sys
+
+WORDS = os.path.join(os.path.dirname(__file__), "data", "words.txt")
+
+# Empty onsets and codas are listed more than once to make them likelier.
+ONSETS = ["", ""] + ("b c d f g h j k l m n p r s t v w y z ch sh th wh qu "
+                     "bl br cl cr dr fl fr gl gr pl pr sc sk sl sm sn sp st "
+                     "sw tr tw phl scr shr spl spr str thr thw sch schm schw "
+                     "chr sphyg").split()
+VOWELS = "a e i o u y a e i o ea ee ai oo ou ie".split()
+CODAS = ["", "", ""] + ("b ck d g l m n p r s t x ll ng nk nt rd rm rn rt "
+                        "sh sk st th tch").split()
+
+@functools.lru_cache(maxsize=8)
+def words(n, seed=0):
+    """ Return a list of *n* distinct synthetic words, in the order they
+    were generated. The same *n* and *seed* always give the same list. """
+    rng = random.Random(seed)
+    found = {}
+    while len(found) < n:
+        word = "".join(rng.choice(ONSETS) + rng.choice(VOWELS) +
+                       rng.choice(CODAS)
+                       for _ in range(rng.choice((1, 1, 2, 2, 2, 3, 3, 4))))
+        found[word] = None
+    return list(found)
+
+def pairs(n, seed=0):
+    """ Return *n* (word, word reversed) pairs with distinct keys. """
+    return [(word, word[::-1]) for word in words(n, seed)]
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for word in sorted(words(n)):
+        print(word)
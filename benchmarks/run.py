@@ -0,0 +1,171 @@
+""" Run the benchmarks without asv, offline, and print a table of results.
+
+    python -m benchmarks.run [-k PATTERN] [--max-size N] [--repeat R]
+
+Every benchmark runs in a fresh Python process, once for each of its
+parameters, so that the peak resident set size reported for it is its own
+and not left over from an earlier one. ``time_`` benchmarks report the best
+of *R* timings and ``peakmem_`` benchmarks the peak RSS of the process.
+Where a suite is run over several lexicon sizes, the table ends each
+benchmark with how its time grew with the size, as the exponent k of the
+best fit to n^k.
+"""
+
+import argparse
+import importlib
+import itertools
+import json
+import math
+import os
+import pkgutil
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def suites():
+    """ Yield (module name, class) for every benchmark suite. """
+    package = os.path.dirname(os.path.abspath(__file__))
+    for info in sorted(pkgutil.iter_modules([package]), key=lambda m: m.name):
+        if not info.name.startswith("bench_"):
+            continue
+        module = importlib.import_module("benchmarks." + info.name)
+        for name, obj in sorted(vars(module).items()):
+            if (isinstance(obj, type) and obj.__module__ == module.__name__
+                    and _methods(obj)):
+                yield module.__name__, obj
+
+def _methods(suite):
+    return [name for name in sorted(dir(suite))
+            if name.startswith(("time_", "peakmem_"))]
+
+def _paramSets(suite):
+    """ Return the argument tuples a suite is run with, as asv would. """
+    params = getattr(suite, "params", None)
+    if params is None:
+        return [()]
+    if not params or not isinstance(params[0], (list, tuple)):
+        params = [params]
+    return list(itertools.product(*params))
+
+def _peakRSS():
+    """ Return the peak resident set size of this process, in bytes. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def runCase(moduleName, suiteName, methodName, index, repeat):
+    """ Run one benchmark with one set of parameters in this process, and
+    return its results. """
+    suite = getattr(importlib.import_module(moduleName), suiteName)
+    args = _paramSets(suite)[index]
+    bench = suite()
+    if hasattr(bench, "setup"):
+        bench.setup(*args)
+    setupPeak = _peakRSS()
+    method = getattr(bench, methodName)
+    times = []
+    try:
+        for _ in range(repeat if methodName.startswith("time_") else 1):
+            start = time.perf_counter()
+            method(*args)
+            times.append(time.perf_counter() - start)
+    finally:
+        if hasattr(bench, "teardown"):
+            bench.teardown()
+    return {"seconds": min(times), "peak": _peakRSS(), "setupPeak": setupPeak}
+
+def _runIsolated(moduleName, suite, methodName, index, repeat):
+    command = [sys.executable, "-m", "benchmarks.run", "--case", moduleName,
+               suite.__name__, methodName, str(index), "--repeat", str(repeat)]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [ROOT, env.get("PYTHONPATH")]))
+    try:
+        done = subprocess.run(command, cwd=ROOT, env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True,
+                              timeout=getattr(suite, "timeout", 600))
+    except subprocess.TimeoutExpired:
+        return None, "timed out"
+    if done.returncode:
+        lines = done.stderr.strip().splitlines()
+        return None, lines[-1] if lines else "failed"
+    return json.loads(done.stdout.strip().splitlines()[-1]), None
+
+def _size(args):
+    """ Return the lexicon size in *args*, or None if there isn't one. """
+    if args and isinstance(args[0], int) and not isinstance(args[0], bool):
+        return args[0]
+    return None
+
+def _format(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "%.3g %s" % (seconds / scale, unit)
+    return "%.3g ns" % (seconds / 1e-9)
+
+def _exponent(points):
+    """ Return the slope of the least-squares line through log-log
+    *points*, or None if there are fewer than two. """
+    points = [(math.log(n), math.log(t)) for n, t in points if t > 0]
+    if len(points) < 2:
+        return None
+    meanX = sum(x for x, _ in points) / len(points)
+    meanY = sum(y for _, y in points) / len(points)
+    spread = sum((x - meanX) ** 2 for x, _ in points)
+    if not spread:
+        return None
+    return sum((x - meanX) * (y - meanY) for x, y in points) / spread
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-k", dest="pattern", default="",
+                        help="only run benchmarks whose names contain this")
+    parser.add_argument("--max-size", type=int, default=None,
+                        help="skip lexicons larger than this")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timings to take the best of")
+    parser.add_argument("--case", nargs=4, help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+    if options.case:
+        moduleName, suiteName, methodName, index = options.case
+        print(json.dumps(runCase(moduleName, suiteName, methodName,
+                                 int(index), options.repeat)))
+        return
+    for moduleName, suite in suites():
+        for methodName in _methods(suite):
+            name = "%s.%s.%s" % (moduleName.split(".")[-1], suite.__name__,
+                                 methodName)
+            if options.pattern not in name:
+                continue
+            curves = {}
+            for index, args in enumerate(_paramSets(suite)):
+                size = _size(args)
+                if (options.max_size is not None and size is not None
+                        and size > options.max_size):
+                    continue
+                result, error = _runIsolated(moduleName, suite, methodName,
+                                             index, options.repeat)
+                label = "%s(%s)" % (name, ", ".join(map(str, args)))
+                if error is not None:
+                    print("%-72s %s" % (label, error))
+                    continue
+                print("%-72s %10s  peak %7.1f MB  (after setup %.1f MB)" % (
+                        label, _format(result["seconds"]),
+                        result["peak"] / 2**20, result["setupPeak"] / 2**20))
+                sys.stdout.flush()
+                if size is not None:
+                    curves.setdefault(args[1:], []).append(
+                            (size, result["seconds"]))
+            for rest, points in sorted(curves.items()):
+                k = _exponent(points)
+                if k is not None and methodName.startswith("time_"):
+                    print("%-72s %10s" % (
+                            "%s(n, %s)" % (name, ", ".join(map(str, rest)))
+                            if rest else "%s(n)" % name,
+                            "~ n^%.2f" % k))
+
+if __name__ == "__main__":
+    main()
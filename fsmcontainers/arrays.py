@@ -0,0 +1,367 @@
+import io
+import operator
+import re
+import numpy as np
+from .engine import EngineWrapper, countPaths, findAmbiguousPath, \
+                    reachesFinal, intersects, includedIn
+
+_TOKEN = re.compile(r"\\[\[\]\\]|\[[^\[\]]*\]|.", re.DOTALL)
+
+class ArrayWrapper(EngineWrapper):
+    """ A read-only machine flattened into NumPy arrays in compressed sparse
+    row layout. The arcs leaving state *s* are those at positions
+    ``offsets[s]`` to ``offsets[s+1]`` of ``ilabels``, ``olabels`` and
+    ``targets``, sorted by input label; ``final`` marks the final states.
+    Lookups use nothing but NumPy and walk a whole batch of keys through the
+    machine at once, so a machine exported with :meth:`fromFSM` and saved
+    with :meth:`save` can be served by processes that never import Pynini.
+    """
+
+    fields = ("offsets", "ilabels", "olabels", "targets", "final", "start",
+              "symbolLabels", "symbolStrings")
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.offsets = arrays["offsets"]
+        self.ilabels = arrays["ilabels"]
+        self.olabels = arrays["olabels"]
+        self.targets = arrays["targets"]
+        self.final = arrays["final"]
+        self.start = int(arrays["start"])
+        self.lookupCache = None
+        self.decodeTable = dict(zip(arrays["symbolLabels"].tolist(),
+                                    arrays["symbolStrings"].tolist()))
+        self.encodeTable = {v: k for k, v in self.decodeTable.items()}
+        self.decodeTable[0] = ""
+        # Arcs are sorted by state and then by input label, so combining the
+        # two into one key gives a single sorted array that can be searched
+        # for every (state, label) pair in a batch with one searchsorted.
+        self.radix = int(max(self.ilabels.max(initial=0),
+                             max(self.encodeTable.values(), default=0))) + 1
+        arcStates = np.repeat(np.arange(len(self.final), dtype=np.int64),
+                              np.diff(self.offsets))
+        self.arcKeys = arcStates * self.radix + self.ilabels
+
+    @classmethod
+    def fromFSM(cls, wrapper):
+        """ Flatten a :class:`PyniniWrapper` into arrays. The machine is
+        frozen first, so the arrays describe its optimized form. Raise
+        ValueError if it is weighted, since the arrays hold no weights. """
+        from .wrappers import labelDecoder # Exporting needs Pynini;
+                                           # looking things up doesn't.
+        if wrapper.isWeighted():
+            raise ValueError("Weighted machines can't be flattened into "
+                             "arrays, which hold no weights.")
+        frozen = wrapper if wrapper.frozen else wrapper.freeze()
+        fsm = frozen.fsm
+        numStates = fsm.num_states()
+        final = np.zeros(numStates, dtype=bool)
+        states, ilabels, olabels, targets = [], [], [], []
+        for state in range(numStates):
+            final[state] = frozen.arcIndex.isFinal(state)
+            for arc in fsm.arcs(state):
+                states.append(state)
+                ilabels.append(arc.ilabel)
+                olabels.append(arc.olabel)
+                targets.append(arc.nextstate)
+        states = np.array(states, dtype=np.int64)
+        ilabels = np.array(ilabels, dtype=np.int64)
+        olabels = np.array(olabels, dtype=np.int64)
+        targets = np.array(targets, dtype=np.int64)
+        order = np.lexsort((targets, olabels, ilabels, states))
+        offsets = np.zeros(numStates + 1, dtype=np.int64)
+        np.cumsum(np.bincount(states, minlength=numStates), out=offsets[1:])
+        symbols = {}
+        for labels, table in ((ilabels, fsm.input_symbols()),
+                              (olabels, fsm.output_symbols())):
+            decoder = labelDecoder(table)
+            for label in np.unique(labels).tolist():
+                string = decoder[label]
+                if label and string != chr(label):
+                    symbols[label] = string
+        return cls({
+            "offsets": offsets,
+            "ilabels": ilabels[order],
+            "olabels": olabels[order],
+            "targets": targets[order],
+            "final": final,
+            "start": np.array(fsm.start(), dtype=np.int64),
+            "symbolLabels": np.array(list(symbols.keys()), dtype=np.int64),
+            "symbolStrings": np.array(list(symbols.values()), dtype=str),
+        })
+
+    def save(self, file):
+        """ Save the arrays to *file* with :func:`numpy.savez`. """
+        np.savez(file, **{k: self.arrays[k] for k in self.fields})
+
+    @classmethod
+    def load(cls, file):
+        """ Load arrays saved with :meth:`save`. """
+        with np.load(file) as data:
+            return cls({k: data[k] for k in cls.fields})
+
+    def toString(self):
+        """ Return the arrays as the bytes of a :func:`numpy.savez` file. """
+        buffer = io.BytesIO()
+        self.save(buffer)
+        return buffer.getvalue()
+
+    @classmethod
+    def fromString(cls, string, frozen=True):
+        return cls.load(io.BytesIO(string))
+
+    def __reduce__(self):
+        return (type(self).fromString, (self.toString(),))
+
+    @property
+    def frozen(self):
+        return True
+
+    def freeze(self):
+        return self
+
+    def optimized(self):
+        return self
+
+    def encode(self, item):
+        """ Return the input labels for *item*, or None if it contains a
+        token that no arc of this machine is labelled with. """
+        if "[" not in item and "\\" not in item:
+            labels = [ord(c) for c in item]
+        else:
+            labels = []
+            for token in _TOKEN.findall(item):
+                if len(token) == 1:
+                    labels.append(ord(token))
+                elif token[0] == "\\" or len(token) == 3:
+                    labels.append(ord(token[1])) # An escape or "[x]".
+                elif token[1:-1].isdecimal():
+                    labels.append(int(token[1:-1])) # A label by number.
+                elif token in self.encodeTable:
+                    labels.append(self.encodeTable[token])
+                else:
+                    return None
+        # A label past the radix would make a search key for an arc of the
+        # next state, so it has to be ruled out before keys are built.
+        if labels and max(labels) >= self.radix:
+            return None
+        return labels
+
+    def decode(self, labels):
+        table = self.decodeTable
+        return "".join([table[l] if l in table else chr(l) for l in labels])
+
+    def _expand(self, keys):
+        """ For each search key, find every arc whose (state, input label)
+        key matches it. Return the index of the key each match belongs to and
+        the index of the matching arc. """
+        lo = np.searchsorted(self.arcKeys, keys, side="left")
+        hi = np.searchsorted(self.arcKeys, keys, side="right")
+        counts = hi - lo
+        source = np.repeat(np.arange(len(keys)), counts)
+        firsts = np.repeat(np.cumsum(counts) - counts, counts)
+        arcs = lo[source] + np.arange(len(source)) - firsts
+        return source, arcs
+
+    def _run(self, items):
+        """ Walk every item in *items* through the machine at once. Each row
+        of the walk is one configuration: the item it belongs to, the state
+        it has reached, and a node in a shared history of output labels from
+        which its output can be read back. Return the items, output-history
+        nodes and histories of the configurations that end in a final state
+        after consuming their whole item. """
+        encoded = [self.encode(item) for item in items]
+        lengths = np.array([-1 if e is None else len(e) for e in encoded],
+                           dtype=np.int64)
+        width = int(lengths.max(initial=0))
+        labels = np.zeros((len(items), max(width, 1)), dtype=np.int64)
+        for i, e in enumerate(encoded):
+            if e:
+                labels[i, :len(e)] = e
+        history = _History()
+        rowItems = np.flatnonzero(lengths >= 0)
+        if self.start < 0:
+            rowItems = rowItems[:0]
+        rowStates = np.full(len(rowItems), self.start, dtype=np.int64)
+        rowNodes = np.full(len(rowItems), -1, dtype=np.int64)
+        rows = self._closure(rowItems, rowStates, rowNodes, history)
+        for t in range(width):
+            rowItems, rowStates, rowNodes = rows
+            moving = lengths[rowItems] > t
+            source, arcs = self._expand(
+                    rowStates[moving] * self.radix
+                    + labels[rowItems[moving], t])
+            stepped = self._closure(
+                    rowItems[moving][source],
+                    self.targets[arcs],
+                    history.add(rowNodes[moving][source], self.olabels[arcs]),
+                    history)
+            rows = tuple(np.concatenate([done[~moving], step])
+                         for done, step in zip(rows, stepped))
+        rowItems, rowStates, rowNodes = rows
+        accepted = self.final[rowStates]
+        return rowItems[accepted], rowNodes[accepted], history
+
+    def _closure(self, rowItems, rowStates, rowNodes, history):
+        """ Add to a set of configurations every configuration reachable
+        from them by input-epsilon arcs. """
+        found = [(rowItems, rowStates, rowNodes)]
+        for _ in range(len(self.final) + 1):
+            source, arcs = self._expand(rowStates * self.radix)
+            if not len(arcs):
+                break
+            rowItems = rowItems[source]
+            rowStates = self.targets[arcs]
+            rowNodes = history.add(rowNodes[source], self.olabels[arcs])
+            found.append((rowItems, rowStates, rowNodes))
+        else:
+            raise ValueError("Input maps to infinitely many outputs.")
+        return tuple(np.concatenate(column) for column in zip(*found))
+
+    def acceptsMany(self, items, side="top"):
+        if side != "top":
+            raise ValueError("Array-backed machines only look up keys.")
+        items = list(dict.fromkeys(items))
+        rowItems, _, _ = self._run(items)
+        return {items[i] for i in np.unique(rowItems).tolist()}
+
+    def accepts(self, item, side="top"):
+        return item in self.acceptsMany([item], side)
+
+    def lookupMany(self, items):
+        items = list(dict.fromkeys(items))
+        rowItems, rowNodes, history = self._run(items)
+        outputs = history.read(rowNodes)
+        found = dict.fromkeys((items[i], self.decode(labels))
+                              for i, labels in zip(rowItems.tolist(), outputs))
+        return iter(found)
+
+    def lookup(self, item):
+        return [value for _, value in self.lookupMany([item])]
+
+    def bestLookup(self, item, limit):
+        # Only unweighted machines are flattened into arrays, so every value
+        # ties, and they are listed in sorted order, as ties are elsewhere.
+        return [(value, 0.0) for value in sorted(self.lookup(item))[:limit]]
+
+    def isWeighted(self):
+        return False
+
+    def numPaths(self):
+        offsets, targets = self.offsets, self.targets
+        return countPaths(
+                self.start,
+                lambda state: targets[offsets[state]:offsets[state + 1]].tolist(),
+                lambda state: self.final[state])
+
+    def numPathsCompare(self, n, op=operator.eq):
+        return op(self.numPaths(), n)
+
+    def alphabet(self):
+        inputs = set(np.unique(self.ilabels).tolist()) - {0}
+        outputs = set(np.unique(self.olabels).tolist()) - {0}
+        return frozenset(inputs), frozenset(outputs)
+
+    def alphabetSymbols(self):
+        return tuple(frozenset(self.decode([label]) for label in labels)
+                     for labels in self.alphabet())
+
+    def transitions(self):
+        return (self.start, self._arcTable, lambda state: self.final[state])
+
+    def hasPaths(self):
+        return reachesFinal(self.transitions())
+
+    def isDisjoint(self, other):
+        return not intersects(self.transitions(), other.transitions())
+
+    def isSubset(self, other):
+        return includedIn(self.transitions(), other.transitions())
+
+    def findAmbiguity(self, maxStates=100000, timeout=None):
+        witness = findAmbiguousPath(*self.transitions(),
+                                    maxStates=maxStates, timeout=timeout)
+        if witness is None:
+            return None
+        return tuple(map(self.decode, witness))
+
+    def isFunctional(self, maxStates=100000, timeout=None):
+        return self.findAmbiguity(maxStates, timeout) is None
+
+    def _arcTable(self, state):
+        table = {}
+        for arc in range(self.offsets[state], self.offsets[state + 1]):
+            table.setdefault(int(self.ilabels[arc]), []).append(
+                    (int(self.olabels[arc]), int(self.targets[arc])))
+        return table
+
+    def stats(self):
+        return {
+            "states": len(self.final),
+            "arcs": len(self.targets),
+            "paths": self.numPaths(),
+        }
+
+    def pathIterator(self, limit=None, side=None):
+        """ Yield paths depth-first. Unlike :class:`PyniniWrapper`, a limit
+        gives the first paths found rather than the shortest. """
+        if self.start < 0:
+            return
+        count = 0
+        stack = [(self.start, (), (), frozenset([self.start]))]
+        while stack:
+            state, top, bottom, onPath = stack.pop()
+            if self.final[state]:
+                if side == "top":
+                    yield self.decode(top)
+                elif side == "bottom":
+                    yield self.decode(bottom)
+                else:
+                    yield (self.decode(top), self.decode(bottom))
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            for arc in range(self.offsets[state + 1] - 1,
+                             self.offsets[state] - 1, -1):
+                target = int(self.targets[arc])
+                if target in onPath:
+                    raise ValueError("Can't iterate over a cyclic machine.")
+                stack.append((target,
+                              top + (int(self.ilabels[arc]),),
+                              bottom + (int(self.olabels[arc]),),
+                              onPath | {target}))
+
+
+class _History(object):
+    """ Output labels of a batch walk, stored as a tree of (parent, label)
+    nodes so that configurations can share their common prefixes. """
+
+    def __init__(self):
+        self.parents = []
+        self.labels = []
+        self.size = 0
+
+    def add(self, parents, labels):
+        """ Add a child node with each label under the corresponding parent
+        node, and return the new nodes. """
+        nodes = np.arange(self.size, self.size + len(parents), dtype=np.int64)
+        self.parents.append(parents)
+        self.labels.append(labels)
+        self.size += len(parents)
+        return nodes
+
+    def read(self, nodes):
+        """ Return the nonzero labels on the path to each node, in order. """
+        parents = np.concatenate(self.parents + [np.zeros(0, np.int64)])
+        labels = np.concatenate(self.labels + [np.zeros(0, np.int64)])
+        outputs = [[] for _ in range(len(nodes))]
+        current = np.array(nodes, dtype=np.int64)
+        rows = np.arange(len(nodes))
+        while len(current):
+            live = current >= 0
+            current, rows = current[live], rows[live]
+            for row, label in zip(rows.tolist(), labels[current].tolist()):
+                if label:
+                    outputs[row].append(label)
+            current = parents[current]
+        return [output[::-1] for output in outputs]
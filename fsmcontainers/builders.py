@@ -0,0 +1,69 @@
+class MinimalAcyclicBuilder(object):
+    """ Build the minimal acyclic automaton for a set of label sequences,
+    added one at a time in lexicographic order, following Daciuk, Mihov,
+    Watson and Watson (2000), "Incremental construction of minimal acyclic
+    finite-state automata". Only the path of the most recently added
+    sequence is kept unminimized; everything to the left of it has already
+    been merged into the register of distinct states, so memory is bounded
+    by the size of the minimal automaton rather than the size of the input.
+
+    Labels may be anything hashable and orderable, such as integers for an
+    acceptor or (input, output) pairs for a transducer. """
+
+    def __init__(self):
+        self.states = []   # Finished states as (final, ((label, child), ...))
+        self.register = {} # The same states, mapped to their indices.
+        self.path = [[False, []]] # Unfinished states along the last sequence.
+        self.previous = None
+        self.count = 0
+
+    def add(self, sequence):
+        """ Add *sequence*, which must not sort before any sequence already
+        added. Repeats of the previous sequence are ignored. """
+        sequence = tuple(sequence)
+        if self.previous is not None:
+            if sequence < self.previous:
+                raise ValueError("Input is not sorted: %r follows %r"
+                                 % (sequence, self.previous))
+            if sequence == self.previous:
+                return
+        prefix = 0
+        if self.previous is not None:
+            for a, b in zip(sequence, self.previous):
+                if a != b:
+                    break
+                prefix += 1
+        self._minimize(prefix)
+        for label in sequence[prefix:]:
+            self.path[-1][1].append((label, None))
+            self.path.append([False, []])
+        self.path[-1][0] = True
+        self.previous = sequence
+        self.count += 1
+
+    def finish(self):
+        """ Minimize what remains and return the list of states, each a
+        (final, arcs) pair with arcs as (label, target) pairs, together with
+        the index of the start state. Targets always precede their sources
+        in the list. """
+        self._minimize(0)
+        root = self._register(self.path.pop())
+        return self.states, root
+
+    def _minimize(self, depth):
+        """ Replace the unfinished states deeper than *depth* along the last
+        sequence with their equivalents in the register, adding them to the
+        register if they have none. """
+        while len(self.path) > depth + 1:
+            child = self._register(self.path.pop())
+            arcs = self.path[-1][1]
+            arcs[-1] = (arcs[-1][0], child)
+
+    def _register(self, node):
+        final, arcs = node
+        signature = (final, tuple(arcs))
+        index = self.register.get(signature)
+        if index is None:
+            index = self.register[signature] = len(self.states)
+            self.states.append(signature)
+        return index
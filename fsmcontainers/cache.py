@@ -0,0 +1,254 @@
+import collections
+import functools
+import hashlib
+import inspect
+import os
+import tempfile
+import threading
+import time
+
+CacheInfo = collections.namedtuple(
+        "CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+_missing = object()
+
+class LookupCache(object):
+    """ A bounded least-recently-used cache of lookup results. A cache is
+    attached to a single wrapped FSM and is discarded along with it, so a
+    cached result can never be served for a machine other than the one it
+    was computed from. Hits, misses and evictions are counted so that
+    *maxsize* can be tuned against real traffic. """
+
+    def __init__(self, maxsize=4096):
+        if maxsize < 1:
+            raise ValueError("Cache size must be at least 1")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return the cached result for *key*, or *default* if there is
+        none, and record a hit or miss accordingly. """
+        with self._lock:
+            value = self._entries.get(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ Cache *value* as the result for *key*, evicting the least
+        recently used entry if the cache is full. """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def lookup(self, key, compute):
+        """ Return the cached result for *key*, calling *compute* and caching
+        its result if there is none. Exceptions raised by *compute* are
+        propagated and nothing is cached. """
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self._entries))
+
+    def clear(self):
+        """ Discard all cached results and reset the counters. """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileInput(object):
+    """ A file whose contents, rather than its name, identify it in a
+    compile cache key. See :func:`file_input`. """
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+
+    def fingerprint(self):
+        digest = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return "file:" + digest.hexdigest()
+
+def file_input(path):
+    """ Mark *path* as an input to a compiled machine whose contents
+    matter, so that editing the file invalidates the cached machine. """
+    return FileInput(path)
+
+def _fingerprint(obj):
+    """ Return a string that identifies *obj* as an input to a recipe. """
+    if isinstance(obj, FileInput):
+        return obj.fingerprint()
+    if inspect.isfunction(obj): # A helper that is part of the recipe.
+        return "code:" + _recipe(obj)
+    if hasattr(obj, "fingerprint"): # An fsmcontainer.
+        return "fsm:%s:%s:%s" % (obj.fingerprint(),
+                                 _fingerprint(obj.keySerializer.describe()),
+                                 _fingerprint(obj.valueSerializer.describe()))
+    if isinstance(obj, (bytes, str, int, float, bool, type(None))):
+        return repr(obj)
+    if isinstance(obj, (list, tuple)):
+        return "[" + ",".join(_fingerprint(x) for x in obj) + "]"
+    if isinstance(obj, (set, frozenset)):
+        return "{" + ",".join(sorted(_fingerprint(x) for x in obj)) + "}"
+    if isinstance(obj, dict):
+        return "{" + ",".join(sorted(_fingerprint(k) + ":" + _fingerprint(v)
+                                     for k, v in obj.items())) + "}"
+    return repr(obj)
+
+def _recipe(function):
+    """ Return a string identifying the code of *function*. """
+    try:
+        source = inspect.getsource(function)
+    except (OSError, TypeError):
+        source = repr(function.__code__.co_code)
+    return "%s.%s\n%s" % (function.__module__, function.__qualname__, source)
+
+
+class DiskCache(object):
+    """ A directory of compiled machines, named by a hash of the recipe and
+    inputs that built them and evicted least recently used first once they
+    take up more than *max_bytes*. Several processes can share a directory:
+    machines are written to a temporary file and renamed into place, so a
+    reader never sees a partial file, and a file that disappears under a
+    reader is simply a cache miss. """
+
+    suffix = ".fsmc"
+
+    def __init__(self, directory=None, max_bytes=1 << 30):
+        self.directory = directory or os.environ.get(
+                "FSMCONTAINERS_CACHE",
+                os.path.join(os.path.expanduser("~"), ".cache",
+                             "fsmcontainers"))
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, *parts):
+        """ Return the cache key for a recipe made of *parts*. """
+        digest = hashlib.sha256()
+        digest.update(b"fsmcontainers-cache-1")
+        for part in parts:
+            digest.update(b"\0" + _fingerprint(part).encode("utf8"))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def load(self, key):
+        """ Return the machine cached under *key*, or None. """
+        from .fsmcontainers import fsmcontainer
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path) # Mark as recently used.
+        except FileNotFoundError:
+            return None
+        try:
+            return fsmcontainer.from_bytes(data)
+        except Exception:
+            _remove(path) # Unreadable, perhaps from an older version.
+            return None
+
+    def save(self, key, obj):
+        """ Cache *obj* under *key*, then evict old entries if the cache has
+        grown too large. """
+        f = tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp",
+                                        delete=False)
+        try:
+            with f:
+                f.write(obj.to_bytes())
+            os.replace(f.name, self.path(key))
+        except BaseException:
+            _remove(f.name)
+            raise
+        self.evict()
+
+    def fetch(self, key, build):
+        """ Return the machine cached under *key*, calling *build* and
+        caching its result if there is none. """
+        obj = self.load(key)
+        if obj is None:
+            obj = build()
+            self.save(key, obj)
+        return obj
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits in
+        *max_bytes*, along with temporary files abandoned by writers that
+        died more than an hour ago. """
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(".tmp"):
+                if now - stat.st_mtime > 3600:
+                    _remove(entry.path)
+            elif entry.name.endswith(self.suffix):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix):
+                _remove(entry.path)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def compiled(*key_inputs, directory=None, max_bytes=1 << 30):
+    """
+    Decorator caching the fsmcontainer returned by the decorated function
+    in a :class:`DiskCache`. The cache key is a hash of the function's
+    source, its arguments and *key_inputs*, which should list anything else
+    the result depends on, including any helper functions it calls whose
+    source should be part of the key. Wrap file names in :func:`file_input`
+    to key on their contents::
+
+        @compiled(file_input("/usr/share/dict/words"))
+        def lexicon(path):
+            return fsa.from_file(path)
+
+    The first call builds the machine and stores it; later calls with the
+    same recipe and inputs, in this process or any other, load it instead.
+    """
+    def decorator(function):
+        recipe = _recipe(function)
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            cache = DiskCache(directory, max_bytes)
+            key = cache.key(recipe, key_inputs, args, kwargs)
+            return cache.fetch(key, lambda: function(*args, **kwargs))
+        return wrapper
+    return decorator
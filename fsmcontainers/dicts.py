@@ -0,0 +1,390 @@
+""" A hash-map engine for finite machines.
+
+Most machines are built from a finite list of pairs and afterwards only
+looked up. :class:`DictWrapper` keeps such a machine as a Python dictionary
+from each key to its values, so subscripting, membership tests and
+counting cost what they do on a dictionary, and unions, intersections,
+differences and compositions of two of them are worked out on the
+dictionaries. Anything that needs an automaton, such as a closure, a
+rewrite rule or an operation with a cyclic machine, is done on an
+equivalent :class:`~fsmcontainers.wrappers.PyniniWrapper` instead, which is
+compiled the first time it is needed and kept. Callers never need to know
+which of the two they have.
+"""
+
+import heapq
+import json
+import operator
+from itertools import chain
+from .engine import EngineWrapper
+from .wrappers import PyniniWrapper, _LabelRecorder, _combineLabels, \
+                      _foldLabels, _unionLabels, _composeLabels, \
+                      _intersectLabels, _leftLabels, labelDecoder
+
+def _promoting(name):
+    """ Return a method that does *name* on the compiled form of a
+    :class:`DictWrapper`. """
+    def method(self, *args, **kwargs):
+        return getattr(self.promoted(), name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+class DictWrapper(EngineWrapper):
+    """ Wraps a finite machine held as a dictionary from each input string to
+    a tuple of its distinct output strings. Strings are stored as Pynini
+    reads them back, with escapes resolved and single-character tokens
+    unbracketed, so that two spellings of a string are one entry, as they
+    are in a compiled machine; *spellings* remembers how such strings were
+    written, for compiling them. Like Pynini wrappers, these are never
+    modified once built. """
+
+    def __init__(self, mapping, labels=None, spellings=None, acceptor=False,
+                 frozen=False):
+        self.mapping = mapping
+        self.labels = labels    # As for PyniniWrapper. None if not known
+                                # yet.
+        self.spellings = spellings or {}
+        self.acceptor = acceptor # Every key maps to itself alone.
+        self.isFrozen = frozen  # Set by freeze().
+        self.lookupCache = None # Set by fsmcontainer.enable_cache().
+        self.compiled = None    # Cached by promoted().
+        self.pathCount = None   # Cached by numPaths().
+        self.outputs = None     # Cached by accepts(side="bottom").
+
+    @classmethod
+    def fromPairs(cls, pairs, validated=False):
+        """ Build a machine from (input, output) string pairs, as
+        :meth:`PyniniWrapper.fromPairs` does. """
+        if not validated:
+            pairs = PyniniWrapper.encodePairs(pairs)
+        inputs, outputs = _LabelRecorder(), _LabelRecorder()
+        spellings = {}
+        mapping = {}
+        acceptor = True
+        for k, v in pairs:
+            k = _normalize(inputs.add(k), spellings)
+            v = _normalize(outputs.add(v), spellings)
+            acceptor = acceptor and k == v
+            # Most keys have one value: keep that in a tuple, and only
+            # switch to a dictionary, as an ordered set, for a second one.
+            values = mapping.get(k)
+            if values is None:
+                mapping[k] = (v,)
+            elif type(values) is tuple:
+                if values[0] != v:
+                    mapping[k] = {values[0]: None, v: None}
+            else:
+                values[v] = None
+        for k, values in mapping.items():
+            if type(values) is dict:
+                mapping[k] = tuple(values)
+        return cls(mapping, (inputs.labels(), outputs.labels()), spellings,
+                   acceptor)
+
+    @classmethod
+    def fromItems(cls, items, validated=False):
+        return cls.fromPairs(((i, i) for i in items), validated)
+
+    @classmethod
+    def fromItem(cls, item, validated=False):
+        return cls.fromPairs([(item, item)], validated)
+
+    @classmethod
+    def fromString(cls, string, frozen=False):
+        """ Load a machine from the bytes produced by :meth:`toString`. """
+        data = json.loads(string.decode("utf8"))
+        mapping = {k: tuple(vs) for k, vs in data["mapping"].items()}
+        return cls(mapping, spellings=data["spellings"],
+                   acceptor=data["acceptor"], frozen=frozen)
+
+    def toString(self):
+        """ Return this machine as UTF-8 JSON. """
+        return json.dumps({"mapping": self.mapping,
+                           "spellings": self.spellings,
+                           "acceptor": self.acceptor}).encode("utf8")
+
+    def __reduce__(self):
+        return (type(self), (self.mapping, self.labels, self.spellings,
+                             self.acceptor, self.isFrozen))
+
+    def promoted(self):
+        """ Return the equivalent :class:`PyniniWrapper`, compiling it the
+        first time it is asked for. """
+        if self.compiled is None:
+            spell = self.spellings.get
+            self.compiled = PyniniWrapper.fromPairs(
+                    ((spell(k, k), spell(v, v))
+                     for k, vs in self.mapping.items() for v in vs),
+                    validated=True)
+        return self.compiled
+
+    @property
+    def fsm(self):
+        """ The compiled Pynini machine, for operations on other engines
+        that read it directly. """
+        return self.promoted().fsm
+
+    @property
+    def frozen(self):
+        return self.isFrozen
+
+    def freeze(self):
+        """ Return a copy of this machine marked as frozen. Lookups on a
+        dictionary are as fast as they get either way, so this only keeps
+        :attr:`frozen` meaning, as for other engines, that :meth:`freeze`
+        was called. """
+        if self.isFrozen:
+            return self
+        cls = type(self)
+        obj = cls(self.mapping, self.labels, self.spellings, self.acceptor,
+                  frozen=True)
+        obj.compiled, obj.pathCount = self.compiled, self.pathCount
+        return obj
+
+    def __eq__(self, other):
+        if not isinstance(other, DictWrapper):
+            return self.fingerprint() == other.fingerprint()
+        if len(self.mapping) != len(other.mapping):
+            return False
+        get = other.mapping.get
+        return all(set(vs) == set(get(k, ()))
+                   for k, vs in self.mapping.items())
+
+    def lookup(self, item):
+        """ Return a list of the strings that this machine maps *item* to. """
+        return list(self.mapping.get(_normalize(item), ()))
+
+    def lookupMany(self, items):
+        get = self.mapping.get
+        return ((item, value) for item in dict.fromkeys(items)
+                              for value in get(_normalize(item), ()))
+
+    def bestLookup(self, item, limit):
+        # Nothing is weighted, so every value ties, and they are listed in
+        # sorted order, as ties are by other engines.
+        return [(value, 0.0) for value in sorted(self.lookup(item))[:limit]]
+
+    def accepts(self, item, side="top"):
+        if side == "top":
+            return _normalize(item) in self.mapping
+        if self.outputs is None:
+            self.outputs = {v for vs in self.mapping.values() for v in vs}
+        return _normalize(item) in self.outputs
+
+    def acceptsMany(self, items, side="top"):
+        return {item for item in items if self.accepts(item, side)}
+
+    def pathIterator(self, limit=None, side=None):
+        pairs = ((k, v) for k, vs in self.mapping.items() for v in vs)
+        if limit is not None:
+            pairs = heapq.nsmallest(
+                    limit, pairs, key=lambda pair: (len(pair[0]), pair))
+        if side == "top":
+            return (k for k, _ in pairs)
+        if side == "bottom":
+            return (v for _, v in pairs)
+        return pairs
+
+    def numPaths(self):
+        if self.pathCount is None:
+            self.pathCount = sum(map(len, self.mapping.values()))
+        return self.pathCount
+
+    def numPathsCompare(self, n, op=operator.eq):
+        return op(self.numPaths(), n)
+
+    def isCyclic(self):
+        return False
+
+    def isWeighted(self):
+        return False
+
+    def hasPaths(self):
+        return bool(self.mapping)
+
+    def alphabet(self):
+        if self.labels is None:
+            spell = self.spellings.get
+            inputs, outputs = _LabelRecorder(), _LabelRecorder()
+            for k, vs in self.mapping.items():
+                inputs.add(spell(k, k))
+                for v in vs:
+                    outputs.add(spell(v, v))
+            self.labels = (inputs.labels(), outputs.labels())
+        return self.labels
+
+    def alphabetSymbols(self):
+        decoder = labelDecoder(None)
+        return tuple(frozenset(decoder[label] for label in labels)
+                     for labels in self.alphabet())
+
+    def stats(self):
+        """ Return the number of keys and of paths. A dictionary has no
+        states or arcs, so their numbers are only given if the machine has
+        been compiled already; compiling it just to count them could take
+        far longer than everything else :meth:`toString` is used for. """
+        stats = {
+            "keys": len(self.mapping),
+            "paths": self.numPaths(),
+        }
+        if self.compiled is not None:
+            compiledStats = self.compiled.stats()
+            stats["states"] = compiledStats["states"]
+            stats["arcs"] = compiledStats["arcs"]
+        return stats
+
+    def findAmbiguity(self, maxStates=100000, timeout=None):
+        for k, vs in self.mapping.items():
+            if len(vs) > 1:
+                return (k, vs[0], vs[1])
+        return None
+
+    def isFunctional(self, maxStates=100000, timeout=None):
+        return self.findAmbiguity() is None
+
+    def union(self, other):
+        cls = type(self)
+        return cls.unionAll([self, other])
+
+    @classmethod
+    def unionAll(cls, wrappers):
+        """ Return the union of all of *wrappers*. While they are all
+        dictionaries, they are merged as dictionaries; from the first one
+        that isn't, the rest are unioned by Pynini. """
+        wrappers = iter(wrappers)
+        merged = None
+        for wrapper in wrappers:
+            if not isinstance(wrapper, cls):
+                done = [] if merged is None else [merged]
+                return PyniniWrapper.unionAll(
+                        chain(done, [wrapper], wrappers))
+            if merged is None:
+                merged = cls(dict(wrapper.mapping), wrapper.labels,
+                             dict(wrapper.spellings), wrapper.acceptor)
+                continue
+            # The merged dictionary is ours alone, so it is safe to grow it
+            # in place; operands are not kept once they are merged in.
+            mapping = merged.mapping
+            for k, vs in wrapper.mapping.items():
+                mine = mapping.get(k)
+                mapping[k] = vs if mine is None \
+                             else tuple(dict.fromkeys(mine + vs))
+            merged.spellings.update(wrapper.spellings)
+            merged.labels = _foldLabels(_unionLabels, merged.labels,
+                                        wrapper.labels)
+            merged.acceptor = merged.acceptor and wrapper.acceptor
+        return cls.fromPairs([]) if merged is None else merged
+
+    def _keysIn(self, other):
+        """ Return the keys of this machine that the acceptor *other*
+        accepts. """
+        if isinstance(other, DictWrapper):
+            return {k for k in self.mapping if k in other.mapping}
+        # Other engines are given the keys as they were spelled, and may
+        # give them back either way.
+        names = {k: k for k in self.mapping}
+        names.update((s, k) for k, s in self.spellings.items()
+                            if k in self.mapping)
+        spell = self.spellings.get
+        accepted = other.acceptsMany([spell(k, k) for k in self.mapping])
+        return {names[s] for s in accepted if s in names}
+
+    def _subset(self, keys, labels):
+        cls = type(self)
+        return cls({k: vs for k, vs in self.mapping.items() if k in keys},
+                   labels, self.spellings, self.acceptor)
+
+    def intersect(self, other):
+        # Every string in the intersection is one of ours, so only our keys
+        # need looking up in *other*, whatever kind of machine it is.
+        if not self.acceptor:
+            return self.promoted().intersect(other)
+        return self._subset(self._keysIn(other),
+                            _combineLabels(_intersectLabels, self, other))
+
+    @classmethod
+    def intersectAll(cls, wrappers):
+        wrappers = list(wrappers)
+        if not wrappers:
+            raise ValueError("Intersection of no machines is undefined.")
+        result = wrappers[0]
+        if not isinstance(result, cls):
+            return PyniniWrapper.intersectAll(wrappers)
+        for wrapper in wrappers[1:]:
+            result = result.intersect(wrapper)
+        return result
+
+    def subtract(self, other):
+        if not self.acceptor:
+            return self.promoted().subtract(other)
+        return self._subset(self.mapping.keys() - self._keysIn(other),
+                            _combineLabels(_leftLabels, self, other))
+
+    def subtractAll(self, wrappers):
+        cls = type(self)
+        return self.subtract(cls.unionAll(wrappers))
+
+    def isDisjoint(self, other):
+        return not self._keysIn(other)
+
+    def isSubset(self, other):
+        return len(self._keysIn(other)) == len(self.mapping)
+
+    def compose(self, other):
+        """ Compose with *other*. Two dictionaries are composed directly;
+        any other machine may be cyclic, so this one is compiled to compose
+        with it. """
+        if not isinstance(other, DictWrapper):
+            return self.promoted().compose(other)
+        cls = type(self)
+        get = other.mapping.get
+        mapping = {}
+        for k, vs in self.mapping.items():
+            outputs = tuple(dict.fromkeys(w for v in vs for w in get(v, ())))
+            if outputs:
+                mapping[k] = outputs
+        return cls(mapping, _combineLabels(_composeLabels, self, other),
+                   dict(self.spellings, **other.spellings),
+                   self.acceptor and other.acceptor)
+
+    def project(self, side="top"):
+        if side not in {"top", "bottom"}:
+            raise ValueError
+        cls = type(self)
+        if side == "top":
+            strings = self.mapping
+        else:
+            strings = dict.fromkeys(v for vs in self.mapping.values()
+                                      for v in vs)
+        labels = None
+        if self.labels is not None:
+            labels = (self.labels[side == "bottom"],) * 2
+        return cls({s: (s,) for s in strings}, labels, self.spellings, True)
+
+    @classmethod
+    def concatenateAll(cls, wrappers):
+        return PyniniWrapper.concatenateAll(wrappers)
+
+    fingerprint = _promoting("fingerprint")
+    canonical = _promoting("canonical")
+    optimized = _promoting("optimized")
+    transitions = _promoting("transitions")
+    labelPaths = _promoting("labelPaths")
+    concatenate = _promoting("concatenate")
+    lenientlyCompose = _promoting("lenientlyCompose")
+    cross = _promoting("cross")
+    star = _promoting("star")
+    plus = _promoting("plus")
+    sigma = _promoting("sigma")
+    makeRewrite = _promoting("makeRewrite")
+
+
+def _normalize(string, spellings=None):
+    """ Return *string* as Pynini reads it back, recording its spelling in
+    *spellings* if that is different. """
+    if "[" not in string and "\\" not in string:
+        return string
+    normal = PyniniWrapper.normalizeString(string)
+    if spellings is not None and normal != string:
+        spellings[normal] = string
+    return normal
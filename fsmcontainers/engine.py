@@ -0,0 +1,409 @@
+#pylint: disable=bad-whitespace
+
+import collections
+import time
+
+NotImplemented = False
+
+class EngineWrapper(object):
+    """ Interface for the engines that store and operate on the machines
+    inside fsmcontainers. This module deliberately imports no engine, so
+    that engines which don't need Pynini can be used without it. """
+    def __init__(self, contents):
+        return NotImplemented
+
+    def __eq__(self, other):
+        return NotImplemented
+
+    def fingerprint(self):
+        return NotImplemented
+
+    def transitions(self):
+        return NotImplemented
+
+    def isDisjoint(self, other):
+        return NotImplemented
+
+    def isSubset(self, other):
+        return NotImplemented
+
+    def accepts(self, item, side="top"):
+        return NotImplemented
+
+    def apply(self, item, direction="down"):
+        return NotImplemented
+
+    def acceptsMany(self, items, side="top"):
+        return NotImplemented
+
+    def lookup(self, item):
+        return NotImplemented
+
+    def lookupMany(self, items):
+        return NotImplemented
+
+    def bestLookup(self, item, limit):
+        return NotImplemented
+
+    def isWeighted(self):
+        return NotImplemented
+
+    def freeze(self):
+        return NotImplemented
+
+    def optimized(self):
+        return NotImplemented
+
+    def pathIterator(self, limit=None, side=None):
+        return NotImplemented
+
+    def numPaths(self):
+        return NotImplemented
+
+    def alphabet(self):
+        return NotImplemented
+
+    def alphabetSymbols(self):
+        return NotImplemented
+
+    def stats(self):
+        return NotImplemented
+
+    @classmethod
+    def fromString(cls, string, frozen=False):
+        return NotImplemented
+
+    def toString(self):
+        return NotImplemented
+
+    def concatenate(self, other):
+        return NotImplemented
+
+    def union(self, other):
+        return NotImplemented
+
+    def priorityUnion(self, other):
+        return NotImplemented
+
+    @classmethod
+    def unionAll(cls, wrappers):
+        return NotImplemented
+
+    @classmethod
+    def concatenateAll(cls, wrappers):
+        return NotImplemented
+
+    @classmethod
+    def intersectAll(cls, wrappers):
+        return NotImplemented
+
+    def subtractAll(self, wrappers):
+        return NotImplemented
+
+    def intersect(self, other):
+        return NotImplemented
+
+    def subtract(self, other):
+        return NotImplemented
+
+    def compose(self, other):
+        return NotImplemented
+
+    def lenientlyCompose(self, other):
+        return NotImplemented
+
+    def project(self, other, side):
+        return NotImplemented
+
+    def star(self):
+        return NotImplemented
+
+    def plus(self):
+        return NotImplemented
+
+    def sigma(self):
+        return NotImplemented
+
+    def makeRewrite(self, 
+                    leftEnvironment=None, rightEnvironment=None,
+                    leftBottomTape=False, rightBottomTape=False):
+        return NotImplemented
+
+    def findAmbiguity(self, maxStates=100000, timeout=None):
+        return NotImplemented
+
+    def isFunctional(self, maxStates=100000, timeout=None):
+        return NotImplemented
+
+
+def countPaths(start, successors, isFinal):
+    """ Count the paths from *start* to a final state of an acyclic machine
+    by dynamic programming, visiting each state and arc once rather than
+    enumerating paths: the count for a state is 1 if it is final plus the
+    counts of the targets of its arcs. *successors(state)* must return the
+    target of each arc leaving *state*. Return :literal:`float('inf')` if a
+    cycle is reachable from *start*, which for a trimmed machine means
+    there are infinitely many paths. """
+    if start < 0:
+        return 0
+    counts = {}
+    onPath = {start}
+    stack = [(start, list(successors(start)), 0)]
+    while stack:
+        state, targets, visited = stack[-1]
+        if visited < len(targets):
+            stack[-1] = (state, targets, visited + 1)
+            target = targets[visited]
+            if target in onPath:
+                return float('inf')
+            if target not in counts:
+                onPath.add(target)
+                stack.append((target, list(successors(target)), 0))
+            continue
+        stack.pop()
+        onPath.discard(state)
+        counts[state] = int(isFinal(state)) + sum(counts[t] for t in targets)
+    return counts[start]
+
+def findAmbiguousPath(start, arcs, isFinal, maxStates=100000, timeout=None):
+    """ Decide exactly whether a transducer is functional, that is, maps
+    each input to at most one output, by the squared-automaton method of
+    Beal, Carton, Prieur and Sakarovitch (2003), "Squaring transducers".
+    *arcs(state)* must return a mapping from each input label to a list of
+    (output label, target) pairs, with label 0 for epsilon.
+
+    The squared automaton runs two copies of the transducer side by side on
+    the same input. In a functional transducer every pair of states that
+    can still reach a pair of final states has a single delay, the output
+    one copy has produced that the other has yet to, and pairs of final
+    states have none. Return None if that holds, or otherwise a witness
+    (input labels, output labels, other output labels) whose two outputs
+    differ.
+
+    Raise RuntimeError if the squared automaton has more than *maxStates*
+    states or the search takes longer than *timeout* seconds. """
+    if start < 0:
+        return None
+    deadline = None if timeout is None else time.monotonic() + timeout
+    root = (start, start, False)
+
+    # Build the reachable part of the squared automaton.
+    moves = {root: []}
+    incoming = collections.defaultdict(list)
+    finals = []
+    queue = collections.deque([root])
+    while queue:
+        pair = queue.popleft()
+        _checkBudget(len(moves), maxStates, deadline)
+        if isFinal(pair[0]) and isFinal(pair[1]):
+            finals.append(pair)
+        for move in _pairMoves(arcs, *pair):
+            target = move[3]
+            moves[pair].append(move)
+            incoming[target].append((pair, move))
+            if target not in moves:
+                moves[target] = []
+                queue.append(target)
+
+    # Find the pairs that can reach a pair of final states, and the first
+    # move of a shortest way there from each.
+    onward = dict.fromkeys(finals)
+    queue = collections.deque(finals)
+    while queue:
+        pair = queue.popleft()
+        _checkBudget(0, maxStates, deadline)
+        for source, move in incoming[pair]:
+            if source not in onward:
+                onward[source] = move
+                queue.append(source)
+    if root not in onward:
+        return None
+
+    # Give each useful pair a delay, and look for one with two.
+    delays = {root: ((), ())}
+    routes = {root: None}
+    queue = collections.deque([root])
+    while queue:
+        pair = queue.popleft()
+        _checkBudget(0, maxStates, deadline)
+        delay = delays[pair]
+        if delay != ((), ()) and onward[pair] is None:
+            return _witness(routes, onward, pair, None)
+        for move in moves[pair]:
+            target = move[3]
+            if target not in onward:
+                continue
+            shifted = _shiftDelay(delay, move[1], move[2])
+            if shifted is None:
+                return _witness(routes, onward, pair, move)
+            if target not in delays:
+                delays[target] = shifted
+                routes[target] = (pair, move)
+                queue.append(target)
+            elif delays[target] != shifted:
+                # One of the two ways into the target, followed by the same
+                # way on to the end, gives two different outputs.
+                witness = _witness(routes, onward, pair, move)
+                if witness is not None:
+                    return witness
+                return _witness(routes, onward, target, None)
+    return None
+
+def _checkBudget(size, maxStates, deadline):
+    if size > maxStates:
+        raise RuntimeError("Ambiguity check gave up after %d states."
+                           % maxStates)
+    if deadline is not None and time.monotonic() > deadline:
+        raise RuntimeError("Ambiguity check timed out.")
+
+def _pairMoves(arcs, left, right, waiting):
+    """ Yield the moves of the squared automaton from the pair of states
+    (*left*, *right*) as (input, left output, right output, target). Between
+    two input symbols, the left copy takes all of its epsilon moves before
+    the right copy takes any, which *waiting* records, so that each pair of
+    paths is followed only once. """
+    leftArcs, rightArcs = arcs(left), arcs(right)
+    for ilabel, leftTargets in leftArcs.items():
+        for x, nextLeft in leftTargets:
+            if ilabel == 0:
+                if not waiting:
+                    yield (0, x, 0, (nextLeft, right, False))
+                continue
+            for y, nextRight in rightArcs.get(ilabel, ()):
+                yield (ilabel, x, y, (nextLeft, nextRight, False))
+    for y, nextRight in rightArcs.get(0, ()):
+        yield (0, 0, y, (left, nextRight, True))
+
+def _shiftDelay(delay, x, y):
+    """ Extend *delay* with the output labels *x* and *y* and cancel their
+    common prefix. Return None if neither output is a prefix of the other,
+    since then they can never be made equal. """
+    left = delay[0] + (x,) if x else delay[0]
+    right = delay[1] + (y,) if y else delay[1]
+    common = 0
+    for a, b in zip(left, right):
+        if a != b:
+            break
+        common += 1
+    left, right = left[common:], right[common:]
+    if left and right:
+        return None
+    return (left, right)
+
+def _witness(routes, onward, pair, move):
+    """ Return the labels of the path that reaches *pair* the way recorded
+    in *routes*, takes *move* if given, and then goes on to a pair of final
+    states, or None if its two outputs are the same. """
+    path = []
+    state = pair
+    while routes[state] is not None:
+        state, previous = routes[state]
+        path.append(previous)
+    path.reverse()
+    if move is not None:
+        path.append(move)
+        pair = move[3]
+    while onward[pair] is not None:
+        path.append(onward[pair])
+        pair = onward[pair][3]
+    inputs = tuple(m[0] for m in path if m[0])
+    left = tuple(m[1] for m in path if m[1])
+    right = tuple(m[2] for m in path if m[2])
+    if left == right:
+        return None
+    return (inputs, left, right)
+
+def reachesFinal(machine):
+    """ Return True if a final state of *machine*, given as a triple
+    (start, arcs, isFinal) as for :func:`findAmbiguousPath`, can be reached
+    from its start state. The search stops at the first one found. """
+    start, arcs, isFinal = machine
+    if start < 0:
+        return False
+    seen = {start}
+    stack = [start]
+    while stack:
+        state = stack.pop()
+        if isFinal(state):
+            return True
+        for targets in arcs(state).values():
+            for _, target in targets:
+                if target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+    return False
+
+def intersects(left, right):
+    """ Return True if the acceptors *left* and *right*, given as triples
+    as for :func:`reachesFinal`, accept a string in common. Pairs of states
+    are visited as they are reached, and the search stops at the first pair
+    of final states, so the product is never built. """
+    leftStart, leftArcs, leftFinal = left
+    rightStart, rightArcs, rightFinal = right
+    if leftStart < 0 or rightStart < 0:
+        return False
+    root = (leftStart, rightStart)
+    seen = {root}
+    stack = [root]
+    while stack:
+        p, q = stack.pop()
+        if leftFinal(p) and rightFinal(q):
+            return True
+        rightTable = rightArcs(q)
+        targets = [(p, t) for _, t in rightTable.get(0, ())]
+        for label, leftTargets in leftArcs(p).items():
+            if label == 0:
+                targets.extend((t, q) for _, t in leftTargets)
+                continue
+            rightTargets = rightTable.get(label, ())
+            targets.extend((t, u) for _, t in leftTargets
+                                  for _, u in rightTargets)
+        for target in targets:
+            if target not in seen:
+                seen.add(target)
+                stack.append(target)
+    return False
+
+def includedIn(left, right):
+    """ Return True if every string accepted by the acceptor *left* is
+    accepted by the acceptor *right*, both given as triples as for
+    :func:`reachesFinal`. *right* is determinized on the fly, one set of
+    states at a time, as the search through *left* needs it, and the search
+    stops at the first string accepted by *left* alone. """
+    leftStart, leftArcs, leftFinal = left
+    rightStart, rightArcs, rightFinal = right
+    if leftStart < 0:
+        return True
+    closure = lambda states: _epsilonClosure(rightArcs, states)
+    root = (leftStart, closure([rightStart] if rightStart >= 0 else []))
+    seen = {root}
+    stack = [root]
+    steps = {}  # (set of right states, label) -> next set of right states
+    while stack:
+        p, states = stack.pop()
+        if leftFinal(p) and not any(rightFinal(q) for q in states):
+            return False
+        for label, leftTargets in leftArcs(p).items():
+            if label == 0:
+                nextStates = states
+            else:
+                nextStates = steps.get((states, label))
+                if nextStates is None:
+                    nextStates = steps[states, label] = closure(
+                            t for q in states
+                              for _, t in rightArcs(q).get(label, ()))
+            for _, t in leftTargets:
+                if (t, nextStates) not in seen:
+                    seen.add((t, nextStates))
+                    stack.append((t, nextStates))
+    return True
+
+def _epsilonClosure(arcs, states):
+    result = set(states)
+    stack = list(result)
+    while stack:
+        for _, target in arcs(stack.pop()).get(0, ()):
+            if target not in result:
+                result.add(target)
+                stack.append(target)
+    return frozenset(result)
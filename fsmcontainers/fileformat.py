@@ -0,0 +1,59 @@
+""" The fsmcontainers file format.
+
+A file starts with a fixed-size preamble: the magic bytes ``FSMC``, the
+format version as a big-endian unsigned 16-bit integer, and the length of
+the header as a big-endian unsigned 32-bit integer. Then comes the header,
+a UTF-8 JSON object, and then the machine itself in its engine's binary
+format (OpenFST's for Pynini machines). The header describes the container
+class, the key and value serialization protocols, the engine, the
+alphabet and some basic statistics, and can be read without touching the
+machine.
+
+The alphabet is given as the symbols on either side of the machine, as
+strings, since the labels Pynini gives bracketed tokens can differ from one
+process to the next. The statistics always give the number of paths, which
+is null for a cyclic machine. The numbers of states and arcs are given by
+engines that store an automaton, but may be missing for others: a
+dictionary-backed machine only has them once it has been compiled.
+"""
+
+import json
+import struct
+
+MAGIC = b"FSMC"
+VERSION = 1
+_PREAMBLE = struct.Struct(">4sHI")
+
+def pack(header, machine):
+    """ Return the bytes of a file holding *header* and *machine*. """
+    header = json.dumps(dict(header, version=VERSION), sort_keys=True,
+                        allow_nan=False).encode("utf8")
+    return _PREAMBLE.pack(MAGIC, VERSION, len(header)) + header + machine
+
+def unpack(data):
+    """ Split the bytes of a file into its header and its machine. Raise
+    ValueError if *data* is not in this format. """
+    _, size = _parsePreamble(data[:_PREAMBLE.size])
+    end = _PREAMBLE.size + size
+    return json.loads(data[_PREAMBLE.size:end].decode("utf8")), data[end:]
+
+def is_packed(data):
+    """ Return True if *data* starts like a file in this format. """
+    return data[:len(MAGIC)] == MAGIC
+
+def read_header(filename):
+    """ Return the header of the file *filename* without reading its
+    machine. """
+    with open(filename, "rb") as f:
+        _, size = _parsePreamble(f.read(_PREAMBLE.size))
+        return json.loads(f.read(size).decode("utf8"))
+
+def _parsePreamble(preamble):
+    if len(preamble) < _PREAMBLE.size or not is_packed(preamble):
+        raise ValueError("Not an fsmcontainers file.")
+    _, version, size = _PREAMBLE.unpack(preamble)
+    if version > VERSION:
+        raise ValueError("fsmcontainers file format version %d is newer "
+                         "than this library supports (%d)."
+                         % (version, VERSION))
+    return version, size
@@ -1,11 +1,22 @@
-from itertools import chain
-from collections import Mapping, Iterable
+from itertools import chain, islice
+from collections import Mapping, Iterable, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from numbers import Number
+import math
 import operator
+import re
+import sys
 from .wrappers import PyniniWrapper
+from .dicts import DictWrapper
 from .serializers import Serializer
+from .cache import LookupCache
+from . import fileformat
+
+WHITESPACE = re.compile(r"(\s+)")
 
 SIGMA = list("qwertyuiopasdfghjkl;'zxcvbnm,./`1234567890-=QWERTYUIOP{}|ASDFGHJKL:\"ZXCVBNM<>?~!@#$%^&*()_+ ")
+SIGMA_LABELS = frozenset(map(ord, SIGMA))
 
 class fsmcontainer(object):
     """ Abstract base class for containerlike fst and fsa objects. """
@@ -28,8 +39,26 @@ class fsmcontainer(object):
             kproto, vproto = ("", "")
         self.keySerializer = Serializer.from_prototype(kproto)
         self.valueSerializer = Serializer.from_prototype(vproto)
-        self.fsm = PyniniWrapper.fromPairs(self._serializePair(p)
-                                            for p in pairs)
+        self.fsm = DictWrapper.fromPairs(self._serializePairs(pairs),
+                                         validated=True)
+
+    @classmethod
+    def _fromSortedPairs(cls, pairs, acceptor, progress):
+        """ Create a new fsmcontainer from a sorted sequence of (k,v) pairs,
+        building its FSM incrementally. """
+        obj = cls.__new__(cls)
+        pairs = iter(pairs)
+        try:
+            kproto, vproto = next(pairs)
+            pairs = chain([(kproto, vproto)], pairs)
+        except StopIteration:
+            kproto, vproto = ("", "")
+        obj.keySerializer = Serializer.from_prototype(kproto)
+        obj.valueSerializer = Serializer.from_prototype(vproto)
+        obj.fsm = PyniniWrapper.fromSortedPairs(
+                obj._serializePairs(pairs),
+                acceptor=acceptor, progress=progress)
+        return obj
 
     def _initializeWithAttributes(self, fsm,
             keySerializer=Serializer.from_prototype(""),
@@ -57,6 +86,13 @@ class fsmcontainer(object):
         k, v = pair
         return (self._serializeKey(k), self._serializeValue(v))
 
+    def _serializePairs(self, pairs, batch_size=4096):
+        """ Serialize (k,v) pairs lazily, a batch at a time. """
+        for batch in _batches(pairs, batch_size):
+            keys = self.keySerializer.serialize_many(k for k, _ in batch)
+            values = self.valueSerializer.serialize_many(v for _, v in batch)
+            yield from zip(keys, values)
+
     def _serializeKey(self, key):
         return self.keySerializer.serialize(key)
 
@@ -89,12 +125,11 @@ class fsmcontainer(object):
         >>> other = fsa('c', 'd')
         >>> sorted(this + other)
         ['ac', 'ad', 'bc', 'bd']
+        >>> sorted(this.concatenate(other, 'e'))
+        ['ace', 'ade', 'bce', 'bde']
         """
-        obj = self.copy()
-        cls = type(self)
-        for other in others:
-            obj = obj + cls(other)
-        return obj
+        return self._naryOp(type(self.fsm).concatenateAll,
+                            chain([self.fsm], self._operands(others)))
 
     def __or__(self, other):
         return self._binaryOp(other, op=self.fsm.union)
@@ -102,15 +137,41 @@ class fsmcontainer(object):
     def union(self, *others):
         """
         Return an fsm containing all the items from *self* and all the
-        items from each of the *others*.
+        items from each of the *others*. The *others* may also be given as a
+        single iterable, such as a generator; they are unioned in one pass
+        and optimized once, without building intermediate results.
+
+        >>> sorted(fsa('a').union(fsa(c) for c in 'bcd'))
+        ['a', 'b', 'c', 'd']
         """
-        obj = self.copy()
-        cls = type(self)
-        if len(others) == 1 and isinstance(others[0], Iterable):
+        if (len(others) == 1 and isinstance(others[0], Iterable) and
+                not isinstance(others[0], (str, fsmcontainer))):
             others = others[0]
+        return self._naryOp(type(self.fsm).unionAll,
+                            chain([self.fsm], self._operands(others)))
+
+    def _operands(self, others):
+        """
+        Helper generator for n-ary operations. Converts each of *others* in
+        turn to this instance's type, checks that its serialization protocols
+        are compatible, and yields its wrapped FSM.
+        """
+        cls = type(self)
         for other in others:
-            obj = obj | cls(other)
-        return obj
+            other = cls(other)
+            self._typecheck(other)
+            yield other.fsm
+
+    def _naryOp(self, op, fsms):
+        """
+        Helper function for implementing n-ary operations: apply *op* to a
+        sequence of wrapped FSMs and give the result this instance's
+        serialization protocols.
+        """
+        cls = type(self)
+        return cls.fromAttributes(fsm=op(fsms),
+                                  keySerializer=self.keySerializer,
+                                  valueSerializer=self.valueSerializer)
 
     def _binaryOp(self, other, op):
         """
@@ -157,15 +218,134 @@ class fsmcontainer(object):
         Return true if this instance has *keyOrElement* as an element (for
         `fsa`) or as a key (for `fst`).
         """
-        return self.fsm.accepts(self.keySerializer.serialize(keyOrElement))
+        key = self.keySerializer.serialize(keyOrElement)
+        return self._cached("contains", key, lambda: self.fsm.accepts(key))
+
+    def contains_many(self, items, batch_size=1024):
+        """
+        Return a list of booleans saying, for each of *items* in turn,
+        whether it is an element (for `fsa`) or a key (for `fst`) of this
+        instance. Items are checked *batch_size* at a time, with one
+        composition per batch, which is much faster than testing them one by
+        one with :literal:`in`.
+
+            >>> a = fsa({'one', 'two', 'three'})
+            >>> a.contains_many(['one', 'four', 'three'])
+            [True, False, True]
+
+        Items spelled with bracketed tokens are found however the machine
+        is stored:
+
+            >>> items = ['a[b]', '[cd]']
+            >>> for a in (fsa(items), fsa.from_sorted(items),
+            ...           fsa.from_sorted(items).freeze(),
+            ...           fsa(items).to_arrays()):
+            ...     print(a.contains_many(['a[b]', 'ab', '[cd]', 'cd']))
+            [True, True, True, False]
+            [True, True, True, False]
+            [True, True, True, False]
+            [True, True, True, False]
+        """
+        cache = self.fsm.lookupCache
+        results = []
+        for batch in _batches(items, batch_size):
+            serialized = self.keySerializer.serialize_many(batch)
+            if cache is None:
+                accepted = self.fsm.acceptsMany(serialized)
+                results.extend(s in accepted for s in serialized)
+                continue
+            found = {s: cache.get(("contains", s)) for s in serialized}
+            misses = [s for s, hit in found.items() if hit is None]
+            if misses:
+                accepted = self.fsm.acceptsMany(misses)
+                for s in misses:
+                    found[s] = s in accepted
+                    cache.put(("contains", s), found[s])
+            results.extend(found[s] for s in serialized)
+        return results
+
+    def enable_cache(self, maxsize=4096):
+        """
+        Start caching the results of :literal:`in`, subscripting and
+        :meth:`fst.query` on this instance, keeping at most *maxsize* results
+        and evicting the least recently used ones first. The cache belongs to
+        the underlying machine, so it is shared with copies of this instance
+        but never with instances derived from it by other operations. Return
+        this instance.
+
+            >>> a = fsa({'one', 'two'}).enable_cache(maxsize=100)
+            >>> 'one' in a, 'one' in a, 'three' in a
+            (True, True, False)
+            >>> a.cache_info()
+            CacheInfo(hits=1, misses=2, evictions=0, maxsize=100, currsize=2)
+        """
+        self.fsm.lookupCache = LookupCache(maxsize)
+        return self
+
+    def disable_cache(self):
+        """ Stop caching lookup results and discard any cached so far. """
+        self.fsm.lookupCache = None
+
+    def cache_info(self):
+        """ Return a named tuple of hit, miss and eviction counts and the
+        current and maximum size of the lookup cache, or None if caching is
+        not enabled. """
+        cache = self.fsm.lookupCache
+        return cache.info() if cache is not None else None
+
+    def cache_clear(self):
+        """ Discard all cached lookup results and reset the counters. """
+        cache = self.fsm.lookupCache
+        if cache is not None:
+            cache.clear()
+
+    def _cached(self, kind, key, compute):
+        """ Helper function returning the result of *compute()*, served from
+        the lookup cache under (*kind*, *key*) if caching is enabled. """
+        cache = self.fsm.lookupCache
+        if cache is None:
+            return compute()
+        return cache.lookup((kind, key), compute)
 
     def __len__(self):
         """
-        Return the number of elements in this instance. If this is a cyclic
-        acceptor with an infinite number of elements, return
+        Return the number of elements in this instance. Raise ValueError if
+        it is cyclic, and so has infinitely many, or OverflowError if it has
+        too many for :func:`len` to return; :meth:`count_paths` gives the
+        number in either case.
+
+            >>> len(fsa({'a', 'b'}))
+            2
+            >>> len(fsa('a').star())
+            Traceback (most recent call last):
+              ...
+            ValueError: Cyclic machine has infinitely many paths; use count_paths().
+        """
+        paths = self.fsm.numPaths()
+        if paths == float('inf'):
+            raise ValueError("Cyclic machine has infinitely many paths; "
+                             "use count_paths().")
+        if paths > sys.maxsize:
+            raise OverflowError("Machine has %d paths, too many for len(); "
+                                "use count_paths()." % paths)
+        return paths
+
+    def __bool__(self):
+        return self.fsm.hasPaths()
+
+    def count_paths(self):
+        """
+        Return the exact number of paths through the machine in this
+        instance, which is its number of elements (for `fsa`) or (k,v)
+        pairs (for `fst`), however large. If it is cyclic, return
         :literal:`float('inf')`.
+
+            >>> (fsa('a', 'b') + fsa('a', 'b')).count_paths()
+            4
+            >>> fsa('a').star().count_paths()
+            inf
         """
-        return len(list(self.fsm.pathIterator()))
+        return self.fsm.numPaths()
 
     def len_compare(self, n, op=operator.eq):
         """
@@ -196,6 +376,8 @@ class fsmcontainer(object):
          >>> a.len_compare("aardvark")
          False
     """
+        if isinstance(n, fsmcontainer):
+            n = n.count_paths() # Which len() can't give for a cyclic one.
         if n == float('inf'):
             return self.fsm.isCyclic()
         if isinstance(n, Iterable):
@@ -232,13 +414,82 @@ class fsmcontainer(object):
         same elements as this instance. For an `fst`, return True if other is a
         mapping or `fst` with the same keys and values associated in the same
         way, or if it is an iterable containing all of the (k,v) pairs from
-        this instance. """
+        this instance.
+
+        A plain Python collection is not compiled into a machine. Instead
+        the sizes are compared first, and then the members of the collection
+        are looked up in batches, stopping at the first one that is missing.
+
+            >>> fsa({'one', 'two'}) == ['two', 'one', 'two']
+            True
+            >>> fst({'a': '1', 'b': '2'}) == {'a': '1', 'b': '3'}
+            False
+            >>> fst({'a': '1'}).star() == {'a': '1'}
+            False
+        """
         cls = type(self)
+        if _isCollection(other):
+            return self._equalsCollection(other)
         other = cls(other)
         return self.fsm == other.fsm
         # TODO: also check that self and other have compatible serialization
         # protocols.
 
+    def __hash__(self):
+        """
+        Return a hash that agrees with :literal:`==`. A finite instance
+        compares equal to a frozenset of its elements (for `fsa`) or its
+        (k,v) pairs (for `fst`), so it hashes as that frozenset does; the
+        elements are read once and the hash is kept. No collection equals a
+        cyclic instance, which hashes by its fingerprint.
+
+            >>> hash(fsa({'a', 'b'})) == hash(frozenset({'a', 'b'}))
+            True
+            >>> len({fsa('a').star(), fsa('a').plus() | fsa('')})
+            1
+        """
+        try:
+            return self._hash
+        except AttributeError:
+            pass
+        if self.fsm.numPaths() == float('inf'):
+            self._hash = hash(self.fingerprint())
+        else:
+            self._hash = hash(frozenset(self._members()))
+        return self._hash
+
+    def _containsAll(self, items, batch_size=1024):
+        """ Return True if every one of *items* is an element (for `fsa`) or
+        a key (for `fst`) of this instance, checking them a batch at a time
+        and stopping at the first batch with a missing item. """
+        for batch in _batches(items, batch_size):
+            if not all(self.contains_many(batch, batch_size)):
+                return False
+        return True
+
+    def fingerprint(self):
+        """
+        Return a hex digest that identifies the contents of this instance.
+        Equal instances have the same fingerprint, whichever way they were
+        built and in whichever process, so fingerprints can be used to
+        deduplicate machines or as cache keys. It is computed once, from a
+        canonical minimal form of the machine, and kept.
+
+            >>> a = fsa({'ab', 'ac'})
+            >>> b = fsa({'ac'}) | fsa({'ab'})
+            >>> a.fingerprint() == b.fingerprint(), len({a, b})
+            (True, 1)
+
+        This holds for transducers too, however their outputs were lined up
+        with their inputs, and wherever their epsilons fall:
+
+            >>> c = fst({'ab': 'x', 'c': 'yz'})
+            >>> d = fst.from_sorted([('ab', 'x'), ('c', 'yz')])
+            >>> c.fingerprint() == d.fingerprint()
+            True
+        """
+        return self.fsm.fingerprint()
+
     def copy(self):
         cls = type(self)
         return cls.fromAttributes(self.fsm,
@@ -291,8 +542,142 @@ class fsmcontainer(object):
         return cls.fromAttributes(self.fsm.plus(), self.keySerializer,
                 self.valueSerializer)
 
+    def freeze(self):
+        """
+        Return a read-only version of this instance that is prepared for
+        fast lookups. Membership tests and subscripting on the result walk
+        the machine's transitions directly, symbol by symbol, instead of
+        building and composing a new machine for every lookup.
+
+             >>> a = fsa({'cat', 'cats', 'dog'})
+             >>> a.frozen
+             False
+             >>> a = a.freeze()
+             >>> a.frozen
+             True
+             >>> 'cats' in a, 'ca' in a
+             (True, False)
+        """
+        cls = type(self)
+        return cls.fromAttributes(self.fsm.freeze(), self.keySerializer,
+                self.valueSerializer)
+
+    @property
+    def frozen(self):
+        return self.fsm.frozen
+
+    def to_arrays(self):
+        """
+        Return a read-only version of this instance whose machine is stored
+        as flat NumPy arrays (see :class:`fsmcontainers.arrays.ArrayWrapper`)
+        and looked up without Pynini. Requires NumPy. The arrays hold no
+        weights, so a weighted instance raises ValueError.
+
+             >>> d = fst({'one': '1', 'two': '2'}).to_arrays()
+             >>> d['two']
+             '2'
+             >>> d.lookup_many(['one', 'three'])
+             {'one': ['1'], 'three': []}
+
+        Symbols that the machine has no arcs for are never found:
+
+             >>> e = fst([('abab', 'bcb'), ('a', 'abb')]).to_arrays()
+             >>> e.lookup_many(['c', 'z']), e.contains_many(['c', 'z'])
+             ({'c': [], 'z': []}, [False, False])
+             >>> fst.from_weighted([('a', 'x', 1)]).to_arrays()
+             Traceback (most recent call last):
+               ...
+             ValueError: Weighted machines can't be flattened into arrays, which hold no weights.
+        """
+        from .arrays import ArrayWrapper
+        cls = type(self)
+        fsm = self.fsm
+        if isinstance(fsm, DictWrapper):
+            fsm = fsm.promoted()
+        return cls.fromAttributes(ArrayWrapper.fromFSM(fsm),
+                self.keySerializer, self.valueSerializer)
+
     def write(self, filename):
-        self.fsm.fsm.write(filename)
+        """
+        Write this instance to *filename* in the format described in
+        :mod:`fsmcontainers.fileformat`, which records the serialization
+        protocols along with the machine so that :meth:`read` can restore
+        the instance exactly.
+        """
+        with open(filename, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Read an instance written by :meth:`write`. If this is called on
+        :class:`fsmcontainer` itself, the class of the result is the class
+        that was written. Files holding a bare OpenFST machine can also be
+        read, and are assumed to hold strings.
+        """
+        with open(filename, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    @staticmethod
+    def read_header(filename):
+        """
+        Return the header of a file written by :meth:`write`, which gives
+        the class, serialization protocols, engine, alphabet and size of the
+        instance in it, without loading the machine. Its ``"stats"`` always
+        give the number of ``"paths"``, but the numbers of ``"states"`` and
+        ``"arcs"`` may be missing, as described in
+        :mod:`fsmcontainers.fileformat`.
+        """
+        return fileformat.read_header(filename)
+
+    def to_bytes(self):
+        """
+        Return this instance as the bytes that :meth:`write` would write.
+
+            >>> a = fst({('a', 'b'): 'x', ('c', 'd'): 'y'})
+            >>> b = fsmcontainer.from_bytes(a.to_bytes())
+            >>> type(b).__name__, b[('c', 'd')]
+            ('fst', 'y')
+
+        The header names the symbols of the alphabet, bracketed tokens
+        included, rather than the labels they have in this process:
+
+            >>> c = fst({'a[foo]': 'x'}).star()
+            >>> header, _ = fileformat.unpack(c.to_bytes())
+            >>> header["alphabet"], header["stats"]["paths"]
+            ({'input': ['[foo]', 'a'], 'output': ['x']}, None)
+        """
+        inputs, outputs = self.fsm.alphabetSymbols()
+        # JSON has no infinity, so a cyclic machine's path count is null.
+        stats = {name: None if value == float('inf') else value
+                 for name, value in self.fsm.stats().items()}
+        header = {
+            "class": type(self).__name__,
+            "keySerializer": self.keySerializer.describe(),
+            "valueSerializer": self.valueSerializer.describe(),
+            "engine": type(self.fsm).__name__,
+            "frozen": self.frozen,
+            "alphabet": {"input": sorted(inputs), "output": sorted(outputs)},
+            "stats": stats,
+        }
+        return fileformat.pack(header, self.fsm.toString())
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Return an instance from bytes produced by :meth:`to_bytes`. """
+        if not fileformat.is_packed(data):
+            cls = fst if cls is fsmcontainer else cls
+            return cls.fromAttributes(PyniniWrapper.fromString(data),
+                    Serializer.from_prototype(""),
+                    Serializer.from_prototype(""))
+        header, machine = fileformat.unpack(data)
+        if cls is fsmcontainer:
+            cls = {"fsa": fsa, "fst": fst}[header["class"]]
+        engine = _engine(header["engine"])
+        return cls.fromAttributes(
+                engine.fromString(machine, frozen=header["frozen"]),
+                Serializer.from_description(header["keySerializer"]),
+                Serializer.from_description(header["valueSerializer"]))
 
 class fsa(fsmcontainer):
     """
@@ -355,17 +740,101 @@ class fsa(fsmcontainer):
 #        else:
 #            raise TypeError
 
+    @classmethod
+    def from_sorted(cls, iterable, progress=None):
+        """
+        Return a new :class:`fsa` whose elements are taken from *iterable*,
+        which must be in sorted order. The acceptor is built and minimized
+        incrementally as *iterable* is consumed, so very large word lists
+        can be loaded without holding them in memory. If *progress* is
+        given, it is called from time to time with the number of elements
+        read so far.
+
+        Strictly, elements must be sorted by the labels they compile to.
+        For strings without bracketed tokens that is ordinary sorted order.
+        A bracketed or escaped single character sorts as that character,
+        but a multi-character token such as ``[ab]`` is one symbol that
+        sorts after every ordinary character, so ``'[ab]c'`` comes after
+        ``'a[b]'`` and after ``'z'``.
+
+          >>> a = fsa.from_sorted(['cat', 'cats', 'dog', 'dogs'])
+          >>> len(a), 'dogs' in a, 'do' in a
+          (4, True, False)
+          >>> fsa.from_sorted(['b', 'a'])
+          Traceback (most recent call last):
+            ...
+          ValueError: Input is not sorted: (97,) follows (98,)
+          >>> sorted(fsa.from_sorted(['a[b]', 'z', '[ab]c']))
+          ['[ab]c', 'ab', 'z']
+        """
+        return cls._fromSortedPairs(((i, i) for i in iterable),
+                                    acceptor=True, progress=progress)
+
+    @classmethod
+    def from_file(cls, filename, progress=None, encoding="utf8"):
+        """
+        Return a new :class:`fsa` whose elements are the lines of the sorted
+        file *filename*, built as by :meth:`from_sorted`.
+        """
+        with open(filename, encoding=encoding) as f:
+            return cls.from_sorted((line.rstrip("\n") for line in f),
+                                   progress=progress)
+
     def __repr__(self):
         return self._repr(side="top")
 
+    def _members(self):
+        return iter(self)
+
+    def _equalsCollection(self, other):
+        elements = set(other)
+        return self.len_compare(len(elements)) and self._containsAll(elements)
+
     def isdisjoint(self, other):
-        return not self.fsm.intersect(other.fsm).hasPaths()
+        """
+        Return True if this instance and *other*, which may be an
+        :class:`fsa` or any other collection, have no element in common.
+        Two acceptors are searched side by side for a common element,
+        stopping at the first one found, without building their
+        intersection.
+
+            >>> fsa({'a', 'b'}).isdisjoint(fsa({'b'}).star())
+            False
+        """
+        if _isCollection(other):
+            return not any(any(found) for found in
+                           map(self.contains_many, _batches(other, 1024)))
+        return self.fsm.isDisjoint(other.fsm)
 
     def issubset(self, other):
-        return not self.fsm.subtract(other.fsm).hasPaths()
+        """
+        Return True if every element of this instance is in *other*, which
+        may be an :class:`fsa` or any other collection. A collection is not
+        compiled: the sizes are compared first, and then the elements of
+        this instance are looked up in it until one is missing.
+
+            >>> fsa({'a', 'b'}).issubset(['a', 'b', 'c'])
+            True
+        """
+        if _isCollection(other):
+            elements = set(other)
+            return (self.len_compare(len(elements), operator.le) and
+                    all(element in elements for element in self))
+        return self.fsm.isSubset(other.fsm)
 
     def issuperset(self, other):
-        return not other.fsm.subtract(self.fsm).hasPaths()
+        """
+        Return True if every element of *other*, which may be an
+        :class:`fsa` or any other collection, is in this instance. The
+        elements of a collection are looked up in batches, stopping at the
+        first batch with one that is missing.
+
+            >>> fsa({'a', 'b'}).issuperset({'b', 'c'})
+            False
+        """
+        if _isCollection(other):
+            return self._containsAll(set(other))
+        return other.fsm.isSubset(self.fsm)
 
     def __le__(self, other):
         return self.issubset(other)
@@ -383,21 +852,31 @@ class fsa(fsmcontainer):
         return self._binaryOp(other, op=self.fsm.subtract)
 
     def difference(self, *others):
-        obj = self.copy()
-        cls = type(self)
-        for other in others:
-            obj = obj - cls(other)
-        return obj
+        """
+        Return an :class:`fsa` containing the elements of this instance that
+        are not in any of the *others*. The *others* are unioned and
+        subtracted in a single step.
+
+        >>> sorted(fsa('a', 'b', 'c', 'd').difference({'a'}, fsa('c')))
+        ['b', 'd']
+        """
+        if not others:
+            return self.copy()
+        return self._naryOp(self.fsm.subtractAll, self._operands(others))
 
     def __and__(self, other):
         return self._binaryOp(other, op=self.fsm.intersect)
 
     def intersection(self, *others):
-        obj = self.copy()
-        cls = type(self)
-        for other in others:
-            obj = obj & cls(other)
-        return obj
+        """
+        Return an :class:`fsa` containing the elements common to this
+        instance and all of the *others*, optimized once at the end.
+
+        >>> sorted(fsa('a', 'b', 'c').intersection({'a', 'b'}, ['b', 'c']))
+        ['b']
+        """
+        return self._naryOp(type(self.fsm).intersectAll,
+                            chain([self.fsm], self._operands(others)))
 
     def __xor__(self, other):
         return (self - other) | (other - self)
@@ -436,9 +915,15 @@ class fsa(fsmcontainer):
         True
         >>> 'asdfkhasdfkasdfhkjlasdhkasdjfas' in ~fsa('a')
         True
+
+        Strings are made of the characters in :data:`SIGMA` and the symbols
+        used by this instance. The machine for all such strings is shared
+        between instances with the same symbols.
         """
         cls = type(self)
-        return cls(SIGMA).star() - self
+        universe = PyniniWrapper.sigmaStar(_ruleLabels(self) | SIGMA_LABELS)
+        return cls.fromAttributes(universe.subtract(self.fsm),
+                                  self.keySerializer, self.valueSerializer)
 
     def becomes(self, other):
         this = self.fsm
@@ -485,6 +970,14 @@ class fst(fsmcontainer):
     >>> d = fst([('a', 'b'), ('a', 'c')])
     >>> d['a'] in {'b', 'c'}
     True
+
+    Values can be given weights, by pairing each value with a number. A
+    weight is a cost: lower is better, and :meth:`top_k` returns the best
+    values for a key.
+
+    >>> w = fst([('bank', ('noun', 0.5)), ('bank', ('verb', 2))])
+    >>> w.top_k('bank', 1)
+    [('noun', 0.5)]
     """
     def __init__(self, *args, **kwargs):
         if len(args) > 1:
@@ -498,24 +991,302 @@ class fst(fsmcontainer):
             else:
                 pairs = arg.__iter__()
             pairs = chain(pairs, kwargs.items())
-            self._initializeWithPairs(pairs)
+            first = list(islice(pairs, 1))
+            if first and _isWeighted(first[0][1]):
+                self._initializeWithTriples(
+                        (k, v, w) for k, (v, w) in chain(first, pairs))
+            else:
+                self._initializeWithPairs(chain(first, pairs))
+
+    def _initializeWithTriples(self, triples):
+        """ Set serializers and initialize a weighted FSM based on a
+        sequence of (k,v,weight) triples. """
+        try:
+            kproto, vproto, weight = next(triples)
+            triples = chain([(kproto, vproto, weight)], triples)
+        except StopIteration:
+            kproto, vproto = ("", "")
+        self.keySerializer = Serializer.from_prototype(kproto)
+        self.valueSerializer = Serializer.from_prototype(vproto)
+        self.fsm = PyniniWrapper.fromWeightedPairs(
+                self._serializeTriples(triples), validated=True)
+
+    def _serializeTriples(self, triples, batch_size=4096):
+        """ Serialize (k,v,weight) triples lazily, a batch at a time. """
+        for batch in _batches(triples, batch_size):
+            keys = self.keySerializer.serialize_many(k for k, _, _ in batch)
+            values = self.valueSerializer.serialize_many(
+                    v for _, v, _ in batch)
+            yield from zip(keys, values, (w for _, _, w in batch))
 
     @classmethod
-    def read(cls, filename):
-        return cls.fromAttributes(PyniniWrapper.fromFilename(filename),
-                Serializer.from_prototype(""),
-                Serializer.from_prototype(""))
+    def from_weighted(cls, triples):
+        """
+        Return a new :class:`fst` mapping each key to each value in
+        *triples*, an iterable of (key, value, weight) triples. Weights are
+        costs, which add up along a composition; lower is better.
+
+            >>> d = fst.from_weighted([('a', 'x', 1), ('a', 'y', 0.25)])
+            >>> d.top_k('a', 2)
+            [('y', 0.25), ('x', 1.0)]
+
+        Weighted instances are equal when they give every pair the same
+        weight, however the weight is spread along its path:
+
+            >>> e = fst.from_weighted([('a', '', 0.5)])
+            >>> fst.from_weighted([('ab', 'x', 1)]) == (
+            ...     e + fst.from_weighted([('b', 'x', 0.5)]))
+            True
+        """
+        obj = cls.__new__(cls)
+        obj._initializeWithTriples(iter(triples))
+        return obj
+
+    @classmethod
+    def from_frequencies(cls, counts):
+        """
+        Return a new :class:`fst` mapping keys to values, weighted by how
+        often each pair was seen. *counts* is a mapping from (key, value)
+        pairs to counts, such as a :class:`collections.Counter`, or an
+        iterable of pairs to count. Each pair is weighted by the negative
+        log of the conditional probability of its value given its key, so
+        the most frequent values for a key are its best.
+
+            >>> d = fst.from_frequencies([('bank', 'noun'), ('bank', 'verb'),
+            ...                           ('bank', 'noun'), ('run', 'verb')])
+            >>> [value for value, _ in d.top_k('bank', 2)]
+            ['noun', 'verb']
+        """
+        if not isinstance(counts, Mapping):
+            pairs = list(counts)
+            counts = dict.fromkeys(pairs, 0)
+            for pair in pairs:
+                counts[pair] += 1
+        totals = {}
+        for (key, _), count in counts.items():
+            if not count > 0:
+                raise ValueError("Counts must be positive, not %r." % count)
+            totals[key] = totals.get(key, 0) + count
+        return cls.from_weighted(
+                (key, value, -math.log(count / totals[key]))
+                for (key, value), count in counts.items())
+
+    @classmethod
+    def from_sorted(cls, pairs, progress=None):
+        """
+        Return a new :class:`fst` mapping each key to each value in *pairs*,
+        an iterable of (key, value) pairs in sorted order. The transducer is
+        built and minimized incrementally as *pairs* is consumed, as in
+        :meth:`fsa.from_sorted`. As there, the order is strictly that of the
+        labels keys and values compile to, in which a multi-character token
+        such as ``[ab]`` sorts after every ordinary character, so
+        ``('[ab]c', 'x')`` must come after ``('a[b]', 'y')``, unlike in
+        :func:`sorted`.
+
+          >>> d = fst.from_sorted([('cat', 'noun'), ('run', 'noun'),
+          ...                      ('run', 'verb')])
+          >>> d['cat'], sorted(d.lookup_many(['run'])['run'])
+          ('noun', ['noun', 'verb'])
+          >>> fst.from_sorted([('a[b]', 'y'), ('[ab]c', 'x')])['[ab]c']
+          'x'
+        """
+        return cls._fromSortedPairs(pairs, acceptor=False, progress=progress)
+
+    @classmethod
+    def from_file(cls, filename, progress=None, encoding="utf8",
+                  separator="\t"):
+        """
+        Return a new :class:`fst` built as by :meth:`from_sorted` from the
+        sorted file *filename*, each line of which holds a key and a value
+        divided by *separator*.
+        """
+        with open(filename, encoding=encoding) as f:
+            return cls.from_sorted(
+                    (tuple(line.rstrip("\n").split(separator, 1))
+                     for line in f), progress=progress)
 
     def __repr__(self):
         return self._repr(side="both")
 
     def __getitem__(self, key):
-        return next(iter(self.query({key})))
+        serialized = self._serializeKey(key)
+        return self._cached("getitem", serialized, lambda: self._inflateValue(
+                                next(iter(self.fsm.lookup(serialized)))))
+
+    def top_k(self, key, k):
+        """
+        Return the *k* best values for *key*, as a list of (value, weight)
+        pairs with the lowest weight first. A value that *key* reaches
+        along several paths gets the weight of the best of them. Only the
+        best paths are searched for, so this is quick even for keys with
+        very many values. Values of equal weight are listed in the order of
+        the strings they are serialized to, so unweighted values, which all
+        have weight 0, come out the same way on every engine.
+
+            >>> d = fst([('a', ('x', 3)), ('a', ('y', 1)), ('a', ('z', 2))])
+            >>> d.top_k('a', 2)
+            [('y', 1.0), ('z', 2.0)]
+            >>> d.top_k('b', 2)
+            []
+            >>> e = fst([('a', 'z'), ('a', 'x'), ('a', 'y')])
+            >>> e.top_k('a', 2), e.to_arrays().top_k('a', 2)
+            ([('x', 0.0), ('y', 0.0)], [('x', 0.0), ('y', 0.0)])
+        """
+        if k < 1:
+            raise ValueError("k must be at least 1.")
+        serialized = self._serializeKey(key)
+        return [(self._inflateValue(value), weight) for value, weight in
+                self._cached("top_k", (serialized, k),
+                             lambda: self.fsm.bestLookup(serialized, k))]
+
+    def lookup_many(self, keys, batch_size=1024):
+        """
+        Return a dictionary mapping each of *keys* to a list of all the
+        values it corresponds to. Keys with no values are mapped to an empty
+        list. Keys are looked up *batch_size* at a time, with one composition
+        per batch, which is much faster than subscripting once per key.
+
+            >>> d = fst([('a', '1'), ('a', '2'), ('b', '3')])
+            >>> found = d.lookup_many(['a', 'b', 'c'])
+            >>> sorted(found['a']), found['b'], found['c']
+            (['1', '2'], ['3'], [])
+
+        Keys spelled with bracketed tokens are given back as they were
+        spelled, however the machine is stored:
+
+            >>> pairs = [('a[b]', '1'), ('[cd]', '2')]
+            >>> for d in (fst(pairs), fst.from_sorted(pairs),
+            ...           fst.from_sorted(pairs).freeze(),
+            ...           fst(pairs).to_arrays()):
+            ...     print(d.lookup_many(['a[b]', 'ab', '[cd]']))
+            {'a[b]': ['1'], 'ab': ['1'], '[cd]': ['2']}
+            {'a[b]': ['1'], 'ab': ['1'], '[cd]': ['2']}
+            {'a[b]': ['1'], 'ab': ['1'], '[cd]': ['2']}
+            {'a[b]': ['1'], 'ab': ['1'], '[cd]': ['2']}
+        """
+        cache = self.fsm.lookupCache
+        results = {}
+        for batch in _batches(keys, batch_size):
+            serialized = dict(zip(
+                    self.keySerializer.serialize_many(batch), batch))
+            found = {}
+            if cache is not None:
+                for k in serialized:
+                    hit = cache.get(("lookup", k))
+                    if hit is not None:
+                        found[k] = hit
+            misses = [k for k in serialized if k not in found]
+            if misses:
+                computed = {k: [] for k in misses}
+                for k, v in self.fsm.lookupMany(misses):
+                    computed[k].append(v)
+                for k, vs in computed.items():
+                    found[k] = tuple(vs)
+                    if cache is not None:
+                        cache.put(("lookup", k), found[k])
+            for k, vs in found.items():
+                results[serialized[k]] = self.valueSerializer.inflate_many(vs)
+        return results
+
+    def _members(self):
+        return self.items()
+
+    def _equalsCollection(self, other, batch_size=1024):
+        pairs = set(other.items() if isinstance(other, Mapping) else other)
+        paths = self.count_paths()
+        if paths < len(pairs) or paths == float('inf'):
+            return False
+        for batch in _batches(pairs, batch_size):
+            found = self.lookup_many((k for k, _ in batch), batch_size)
+            if not all(v in found[k] for k, v in batch):
+                return False
+        if paths > len(pairs):
+            # Either there are pairs missing from *other*, or this machine
+            # spells out some pair along more than one path. Only comparing
+            # machines can tell which.
+            return self.fsm == type(self)(pairs).fsm
+        return True
+
+    def find_ambiguity(self, max_states=100000, timeout=None):
+        """
+        Return a key that this instance maps to more than one value, as a
+        triple (key, value, other value), or None if every key has a single
+        value. The check is exact, and looks at pairs of states of the
+        machine rather than at its keys, so it is quick even for instances
+        with very many or infinitely many keys. Raise RuntimeError if it
+        needs more than *max_states* pairs or more than *timeout* seconds.
+
+            >>> fst({'a': '1', 'b': '2'}).find_ambiguity() is None
+            True
+            >>> key, *values = fst([('a', '1'), ('a', '2')]).find_ambiguity()
+            >>> key, sorted(values)
+            ('a', ['1', '2'])
+        """
+        witness = self.fsm.findAmbiguity(max_states, timeout)
+        if witness is None:
+            return None
+        key, value, other = witness
+        return (self._inflateKey(key), self._inflateValue(value),
+                self._inflateValue(other))
+
+    def is_functional(self, max_states=100000, timeout=None):
+        """
+        Return True if this instance maps each key to a single value. See
+        :meth:`find_ambiguity`.
+
+            >>> fst({'a': '1'}).star().is_functional()
+            True
+        """
+        return self.find_ambiguity(max_states, timeout) is None
+
+    def transduce_stream(self, lines, tokenizer=None, workers=None,
+                         processes=False, chunk_size=1000, on_missing="keep"):
+        """
+        Generate the transduction of each of *lines* in turn, looking up
+        each token in it separately rather than building a machine for
+        whole sentences. *tokenizer* splits a line into a list that
+        alternates between tokens to look up and separators to copy through
+        unchanged, as :func:`re.split` does with a capturing group; the
+        default splits on runs of whitespace. Tokens this instance has no
+        value for are copied through unchanged, or raise KeyError if
+        *on_missing* is ``"error"``. Tokens with several values are replaced
+        by the least of them.
+
+            >>> t = fst({'one': '1', 'two': '2'})
+            >>> list(t.transduce_stream(['one two three', 'two  one']))
+            ['1 2 three', '2  1']
+
+        Lines are looked up *chunk_size* at a time with :meth:`lookup_many`.
+        With *workers* set, chunks are spread over that many threads, or
+        processes if *processes* is set, and still come out in order.
+        """
+        tokenizer = tokenizer or WHITESPACE.split
+        chunks = _batches(lines, chunk_size)
+        if not workers:
+            for chunk in chunks:
+                yield from _transduceChunk(self, tokenizer, on_missing, chunk)
+            return
+        if processes:
+            executor = ProcessPoolExecutor(workers,
+                    initializer=_setStreamMachine, initargs=(self,))
+            task = partial(_transduceChunk, None, tokenizer, on_missing)
+        else:
+            executor = ThreadPoolExecutor(workers)
+            task = partial(_transduceChunk, self, tokenizer, on_missing)
+        with executor:
+            pending = deque() # Bounded, so that a huge input isn't read
+                              # into memory ahead of the workers.
+            for chunk in chunks:
+                pending.append(executor.submit(task, chunk))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
 
     def __matmul__(self, other):
         return self._productOp(other, self.fsm.compose, cls=type(self))
 
-    def compose(self, *others):
+    def compose(self, *others, lazy=False):
         """
         Return an :class:`fst` whose key-value mapping comes from composing
         *this* with each of the others in turn. 
@@ -524,7 +1295,16 @@ class fst(fsmcontainer):
         >>> t = fst({'intermediate': 'output'})
         >>> s @ t
         fst([('input', 'output')])
+
+        With *lazy* set, return a :class:`cascade` that keeps the machines
+        separate and only composes them with the inputs it is given.
+
+        >>> c = s.compose(t, lazy=True)
+        >>> c['input']
+        'output'
         """
+        if lazy:
+            return cascade(self, *others)
         obj = self.copy()
         cls = type(self)
         for other in others:
@@ -535,8 +1315,12 @@ class fst(fsmcontainer):
         return other._productOp(self, other.fsm.compose, cls=type(self))
 
     def _pu(self, other):
+        # Only the keys of *other* can get through the complement of this
+        # instance's keys, so subtract from those instead of from all
+        # strings.
         cls = type(self)
-        return self | (~self.keyset() @ cls(other))
+        other = cls(other)
+        return self | ((other.keyset() - self.keyset()) @ other)
 
     def __rshift__(self, other):
         return self._pu(other)
@@ -594,7 +1378,20 @@ class fst(fsmcontainer):
             >>> d.query({'I', 'III'})
             fsa(['one', 'three'])
         """
-        return (fsa(querySet) @ self).valueset()
+        keys = [querySet] if isinstance(querySet, str) else querySet
+        cacheKey = frozenset(self._serializeKey(k) for k in keys)
+        return self._cached("query", cacheKey, lambda: self._query(querySet))
+
+    def _query(self, querySet):
+        # Keys are looked up one by one where that needs no composition.
+        if not (self.frozen or isinstance(self.fsm, DictWrapper)):
+            return (fsa(querySet) @ self).valueset()
+        keys = [querySet] if isinstance(querySet, str) else querySet
+        values = {v for k in keys
+                    for v in self.fsm.lookup(self._serializeKey(k))}
+        return fsa.fromAttributes(fsm=DictWrapper.fromItems(values),
+                                  keySerializer=self.valueSerializer,
+                                  valueSerializer=self.valueSerializer)
 
     def keys(self):
         return self._items(side="top")
@@ -624,15 +1421,178 @@ class fst(fsmcontainer):
         return self._items(side="both")
 
     def between(self, left="", right=""):
+        """
+        Return an :class:`fst` that rewrites keys of this instance as their
+        values wherever they occur between *left* and *right*, and leaves
+        the rest of its input alone. Inputs may use the characters in
+        :data:`SIGMA` and any symbols used by the rule itself. To compile
+        many rules at once, see :func:`fsmcontainers.rules.compile_rules`.
+
+            >>> r = fst({'a': 'b'}).between('c', 'c')
+            >>> r['cac cat']
+            'cbc cat'
+        """
         left = fsa(left)
         right = fsa(right)
-        sigma = fsa(SIGMA).star()
         self._typecheck(left, right)
+        return self._rewrite(left, right,
+                             _ruleLabels(self, left, right) | SIGMA_LABELS)
+
+    def _rewrite(self, left, right, labels):
+        """ Compile this instance as a rewrite rule between the :class:`fsa`
+        contexts *left* and *right*, over strings of *labels*. """
         return fst.fromAttributes(
-                fsm = self.fsm.makeRewrite(left.fsm, right.fsm, sigma=sigma.fsm),
+                fsm = self.fsm.makeRewrite(
+                        left.fsm, right.fsm,
+                        sigma=PyniniWrapper.sigmaStar(labels)),
                 keySerializer = self.keySerializer,
                 valueSerializer = self.valueSerializer)
 
+class cascade(object):
+    """
+    A sequence of :class:`fst` stages, each applied to the output of the one
+    before, that behaves like their composition without ever building it.
+    An input is composed with the first stage alone, and only the outputs
+    it reaches are passed on to the next, so lookups cost about as much as
+    the parts of each stage they actually use, however large the full
+    composition would be.
+
+        >>> c = cascade(fst({'a': 'b', 'x': 'y'}), fst({'b': 'c'}),
+        ...             fst({'c': 'd'}))
+        >>> c['a'], 'a' in c, 'x' in c
+        ('d', True, False)
+        >>> c.materialize()
+        fst([('a', 'd')])
+    """
+
+    def __init__(self, *stages):
+        if not stages:
+            raise ValueError("A cascade needs at least one stage.")
+        stages = [s if isinstance(s, fst) else fst(s) for s in stages]
+        for stage, nextStage in zip(stages, stages[1:]):
+            if stage.valueSerializer != nextStage.keySerializer:
+                raise ValueError
+        self.stages = stages
+        self.keySerializer = stages[0].keySerializer
+        self.valueSerializer = stages[-1].valueSerializer
+
+    def __repr__(self):
+        return "cascade(%s)" % ", ".join(map(repr, self.stages))
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __matmul__(self, other):
+        if isinstance(other, cascade):
+            return cascade(*self.stages, *other.stages)
+        return cascade(*self.stages, other)
+
+    def __rmatmul__(self, other):
+        return cascade(other, *self.stages)
+
+    def query(self, querySet):
+        """
+        Return an :class:`fsa` containing all the values the cascade maps
+        any of *querySet* to, as :meth:`fst.query` does.
+        """
+        current = fsa(querySet)
+        for stage in self.stages:
+            current = (current @ stage).valueset()
+        return current
+
+    def __getitem__(self, key):
+        return next(iter(self.query([key])))
+
+    def __contains__(self, key):
+        return self.query([key]).len_compare(0, operator.gt)
+
+    def lookup_many(self, keys, batch_size=1024):
+        """
+        Return a dictionary mapping each of *keys* to a list of all the
+        values the cascade maps it to, as :meth:`fst.lookup_many` does. Each
+        batch of keys is pushed through the stages as one machine, which
+        keeps the keys on its input side.
+        """
+        results = {}
+        for batch in _batches(keys, batch_size):
+            current = fst((k, k) for k in batch)
+            for stage in self.stages:
+                current = current @ stage
+            found = current.lookup_many(batch, batch_size=len(batch))
+            results.update(found)
+        return results
+
+    def materialize(self):
+        """ Return the full composition of the stages as an :class:`fst`. """
+        return self.stages[0].compose(*self.stages[1:])
+
+def _isWeighted(value):
+    """ Return True if *value* is a (value, weight) pair. """
+    return (type(value) == tuple and len(value) == 2 and
+            isinstance(value[1], Number) and not isinstance(value[1], bool))
+
+def _isCollection(obj):
+    """ Return True if *obj* is a plain Python collection, rather than an
+    fsmcontainer or a string. """
+    return (isinstance(obj, Iterable) and
+            not isinstance(obj, (fsmcontainer, str)))
+
+def _ruleLabels(*machines):
+    """ Return every label used on either side of any of *machines*. """
+    labels = set()
+    for machine in machines:
+        inputs, outputs = machine.fsm.alphabet()
+        labels |= inputs | outputs
+    return frozenset(labels)
+
+def _engine(name):
+    """ Return the engine class called *name*. """
+    if name == "PyniniWrapper":
+        return PyniniWrapper
+    if name == "DictWrapper":
+        return DictWrapper
+    if name == "ArrayWrapper":
+        from .arrays import ArrayWrapper
+        return ArrayWrapper
+    raise ValueError("Unknown engine %r" % (name,))
+
+_streamMachine = None # The machine used by transduce_stream in a worker
+                      # process, installed once when the process starts.
+
+def _setStreamMachine(machine):
+    global _streamMachine
+    _streamMachine = machine
+
+def _transduceChunk(machine, tokenizer, onMissing, lines):
+    """ Transduce a list of *lines* token by token for
+    :meth:`fst.transduce_stream`, and return the list of results. """
+    if machine is None:
+        machine = _streamMachine
+    pieces = [tokenizer(line) for line in lines]
+    found = machine.lookup_many({p for line in pieces for p in line[::2] if p})
+    results = []
+    for line in pieces:
+        out = []
+        for i, piece in enumerate(line):
+            if i % 2 or not piece:
+                out.append(piece)
+            elif found[piece]:
+                out.append(min(found[piece]))
+            elif onMissing == "keep":
+                out.append(piece)
+            else:
+                raise KeyError(piece)
+        results.append("".join(out))
+    return results
+
+def _batches(iterable, size):
+    """ Yield successive lists of at most *size* items from *iterable*. """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,69 @@
+from concurrent.futures import ProcessPoolExecutor
+import operator
+from .fsmcontainers import fsmcontainer
+
+COMBINERS = {
+    "union": operator.or_,
+    "priority_union": operator.rshift,
+}
+
+def build(tasks, combine="union", max_workers=None):
+    """
+    Build an fsmcontainer from independent parts in a pool of worker
+    processes. Each of *tasks* is a tuple ``(function, arg, ...)``; a worker
+    calls ``function(arg, ...)``, which must return an fsmcontainer, and
+    ships it back in OpenFST binary form. The parts are then combined
+    pairwise in a balanced tree, also in the pool, using *combine*: either
+    ``"union"``, ``"priority_union"`` (earlier parts take priority over
+    later ones) or a function of two fsmcontainers. Parts are combined in
+    task order, so the result is the same as combining them one after
+    another in a single process.
+
+    Functions must be picklable, which in practice means defined at the top
+    level of a module. With *max_workers* of 1 everything runs in this
+    process, which is useful for debugging.
+
+        >>> from fsmcontainers.fsmcontainers import fsa
+        >>> sorted(build([(fsa, 'a', 'b'), (fsa, 'c'), (fsa, 'd')]))
+        ['a', 'b', 'c', 'd']
+    """
+    combine = COMBINERS.get(combine, combine)
+    if max_workers == 1:
+        return _reduceTree(list(map(_run, tasks)), combine, map)
+    with ProcessPoolExecutor(max_workers) as executor:
+        return _reduceTree(list(executor.map(_run, tasks)), combine,
+                           executor.map)
+
+def build_from_shards(cls, shards, combine="union", max_workers=None):
+    """
+    Build an instance of *cls* from *shards*, each of which is any argument
+    *cls* accepts, such as a list of (key, value) pairs for an
+    :class:`fst`. Each shard is built in a worker process and the results
+    are combined as by :func:`build`.
+    """
+    return build(((cls, shard) for shard in shards), combine=combine,
+                 max_workers=max_workers)
+
+def _run(task):
+    function, *args = task
+    result = function(*args)
+    if not isinstance(result, fsmcontainer):
+        raise TypeError("Build tasks must return fsmcontainers, not %s"
+                        % type(result).__name__)
+    return result
+
+def _combinePair(args):
+    combine, left, right = args
+    return combine(left, right)
+
+def _reduceTree(parts, combine, mapper):
+    """ Combine adjacent pairs of *parts* with *combine*, level by level,
+    until one is left, using *mapper* to run each level. """
+    if not parts:
+        raise ValueError("Nothing to build.")
+    while len(parts) > 1:
+        pairs = [(combine, parts[i], parts[i + 1])
+                 for i in range(0, len(parts) - 1, 2)]
+        leftover = parts[-1:] if len(parts) % 2 else []
+        parts = list(mapper(_combinePair, pairs)) + leftover
+    return parts[0]
@@ -0,0 +1,138 @@
+""" Compiling many rewrite rules at once.
+
+A grammar of rewrite rules compiles each rule as :meth:`fst.between`
+does, but all of them over one shared alphabet, so the universal language
+each rule needs around it is built once rather than once per rule. The
+rules are compiled in a pool of worker processes, and the result can be
+applied as a cascade, with adjacent rules optionally precomposed, and
+saved for later.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from .fsmcontainers import fsmcontainer, fsa, fst, cascade, SIGMA_LABELS, \
+                           _ruleLabels
+from .wrappers import PyniniWrapper, labelDecoder
+from .serializers import Serializer
+from . import fileformat
+
+def compile_rules(specs, max_workers=None):
+    """
+    Compile *specs*, each a tuple ``(rule, left, right)`` with the
+    arguments of :meth:`fst.between`, into a :class:`ruleset`. Inputs to
+    every rule may use the characters in :data:`SIGMA` and any symbol used
+    by any of the rules. With *max_workers* of 1 everything runs in this
+    process.
+
+        >>> rules = compile_rules([({'a': 'b'}, 'c', ''), ({'b': 'd'}, '', '')],
+        ...                       max_workers=1)
+        >>> len(rules), rules.cascade()['ca']
+        (2, 'cd')
+    """
+    specs = [(fst(rule), fsa(left), fsa(right)) for rule, left, right in specs]
+    labels = _ruleLabels(*(m for spec in specs for m in spec)) | SIGMA_LABELS
+    tasks = [spec + (labels,) for spec in specs]
+    if max_workers == 1:
+        rules = list(map(_compile, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers) as executor:
+            rules = list(executor.map(_compile, tasks))
+    return ruleset(rules, labels)
+
+def _compile(task):
+    rule, left, right, labels = task
+    rule._typecheck(left, right)
+    return rule._rewrite(left, right, labels)
+
+
+class ruleset(object):
+    """
+    A sequence of compiled rewrite rules, applied in order, as returned by
+    :func:`compile_rules`. A ruleset behaves like a list of :class:`fst`
+    rules and can be written to and read from a single file.
+    """
+
+    def __init__(self, rules, labels=None):
+        self.rules = list(rules)
+        self.labels = frozenset(labels) if labels is not None \
+                      else _ruleLabels(*self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __getitem__(self, index):
+        return self.rules[index]
+
+    def __repr__(self):
+        return "ruleset(%d rules)" % len(self.rules)
+
+    def sigma_star(self):
+        """ Return an :class:`fsa` of every string the rules can apply to. """
+        string = Serializer.from_prototype("")
+        return fsa.fromAttributes(PyniniWrapper.sigmaStar(self.labels),
+                                  string, string)
+
+    def cascade(self, group=1, max_workers=None):
+        """
+        Return a :class:`cascade` that applies the rules in order. Each run
+        of *group* adjacent rules is precomposed into a single stage, which
+        makes lookups faster at the cost of larger machines; with *group*
+        of ``len(self)`` or more the result is a plain :class:`fst` holding
+        the composition of all of the rules. Precomposition runs in a pool
+        of *max_workers* processes.
+        """
+        if group < 1:
+            raise ValueError("Rules must be grouped at least one at a time.")
+        groups = [self.rules[i:i + group]
+                  for i in range(0, len(self.rules), group)]
+        if len(groups) == 1:
+            return _composeGroup(groups[0])
+        if group == 1:
+            return cascade(*self.rules)
+        if max_workers == 1:
+            return cascade(*map(_composeGroup, groups))
+        with ProcessPoolExecutor(max_workers) as executor:
+            return cascade(*executor.map(_composeGroup, groups))
+
+    def write(self, filename):
+        """ Write the rules to *filename*, in the format described in
+        :mod:`fsmcontainers.fileformat`. """
+        with open(filename, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def read(cls, filename):
+        """ Read a ruleset written by :meth:`write`. """
+        with open(filename, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    def to_bytes(self):
+        parts = [rule.to_bytes() for rule in self.rules]
+        # Labels of bracketed tokens differ from process to process, so the
+        # alphabet is written as the symbols it stands for.
+        decoder = labelDecoder(None)
+        header = {
+            "class": type(self).__name__,
+            "symbols": sorted(decoder[label] for label in self.labels),
+            "sizes": [len(part) for part in parts],
+        }
+        return fileformat.pack(header, b"".join(parts))
+
+    @classmethod
+    def from_bytes(cls, data):
+        header, machines = fileformat.unpack(data)
+        if header.get("class") != cls.__name__:
+            raise ValueError("Not a %s file." % cls.__name__)
+        rules = []
+        start = 0
+        for size in header["sizes"]:
+            rules.append(fsmcontainer.from_bytes(machines[start:start + size]))
+            start += size
+        return cls(rules, [ord(symbol) if len(symbol) == 1
+                           else PyniniWrapper.stringLabels(symbol)[0]
+                           for symbol in header["symbols"]])
+
+def _composeGroup(rules):
+    return rules[0].compose(*rules[1:])
@@ -1,3 +1,5 @@
+import functools
+import re
 import six
 
 class Serializer(object):
@@ -17,7 +19,13 @@ class Serializer(object):
     serializers = {}
 
     def __init__(self, prototype):
-        pass
+        self.prototype = prototype
+
+    def __reduce__(self):
+        # Unpickle through from_prototype, so that a serializer sent to
+        # another process is still the one and only serializer for its
+        # protocol once it arrives.
+        return (Serializer.from_prototype, (self.prototype,))
 
     def serialize(self, obj):
         return NotImplemented
@@ -25,6 +33,24 @@ class Serializer(object):
     def inflate(self, string):
         return NotImplemented
 
+    def serialize_many(self, objs):
+        """ Return a list of the serializations of each of *objs*. """
+        return [self.serialize(obj) for obj in objs]
+
+    def inflate_many(self, strings):
+        """ Return a list of the objects serialized as each of *strings*. """
+        return [self.inflate(string) for string in strings]
+
+    def describe(self):
+        """ Return a JSON-compatible description of this serializer's
+        protocol, from which from_description can recover the serializer.
+        """
+        return describe_prototype(self.prototype)
+
+    @classmethod
+    def from_description(cls, description):
+        return cls.from_prototype(prototype_from_description(description))
+
     @classmethod
     def from_prototype(cls, obj):
         if isinstance(obj, (six.text_type, six.binary_type)):
@@ -43,67 +69,107 @@ class Serializer(object):
 class StringSerializer(Serializer):
 
     def __init__(self, prototype):
-        pass
+        self.prototype = type(prototype)()
 
     def serialize(self, obj):
+        if isinstance(obj, six.string_types) and _VALID.match(obj):
+            return obj
+        self._raiseInvalid(obj)
+
+    def serialize_many(self, objs):
+        objs = list(objs)
+        # Validate the whole batch with one regular expression match, using
+        # null bytes, which are otherwise forbidden, to separate the items.
+        # If any item is bad, find it and report it the slow way.
+        if all(isinstance(obj, six.string_types) for obj in objs):
+            joined = "\0".join(objs)
+            if (joined.count("\0") == max(len(objs) - 1, 0) and
+                    _VALID_JOINED.match(joined)):
+                return objs
+        for obj in objs:
+            self.serialize(obj)
+        raise AssertionError("Batch failed validation, but no item did.")
+
+    def _raiseInvalid(self, obj):
         if not isinstance(obj, six.string_types):
             raise ValueError(
                 "Non-obj values need to pass through another"
                 "codec first")
         if '\0' in obj or '\1' in obj:
             raise ValueError("Pynini doesn't support null bytes in FSMs")
-        if not braces_balanced(obj):
-            raise ValueError(
-                "Unbalanced [ or ] in input. Braces are used to"
-                "construct multi-character tokens. If you want a literal"
-                "brace character, use '\[' or '\]'")
-        return obj
+        raise ValueError(
+            "Unbalanced [ or ] in input. Braces are used to"
+            "construct multi-character tokens. If you want a literal"
+            "brace character, use '\\[' or '\\]'")
 
     def inflate(self, string):
         return string
 
+    def inflate_many(self, strings):
+        return list(strings)
+
 class TupleSerializer(Serializer):
 
     def __init__(self, prototype):
+        self.prototype = tuple(type(x)() if isinstance(x, six.string_types)
+                               else x for x in prototype)
         self.length = len(prototype)
         self.itemserializers = tuple(Serializer.from_prototype(x) for x in prototype)
+        # The same path strings come up again and again when iterating over
+        # or looking things up in a machine, so remember their inflations.
+        self.inflate = functools.lru_cache(maxsize=1 << 16)(self._inflate)
 
     def serialize(self, obj):
         if len(obj) != self.length:
             raise ValueError
-        obj = tuple(c.serialize(x) for c, x in zip(self.itemserializers, obj))
-        width = max(map(len, obj))
-        strings = [field.ljust(width, '\1') for field in obj]
-        out = ''.join(''.join(s) for s in zip(*strings))
-        return out
+        return self._interleave(
+                [c.serialize(x) for c, x in zip(self.itemserializers, obj)])
 
-    def inflate(self, bts):
+    def serialize_many(self, objs):
+        objs = list(objs)
+        if any(len(obj) != self.length for obj in objs):
+            raise ValueError
+        # Serialize column by column, so that each item serializer can
+        # validate its whole column at once.
+        columns = [c.serialize_many(column) for c, column
+                   in zip(self.itemserializers, zip(*objs))]
+        return [self._interleave(fields) for fields in zip(*columns)]
+
+    def _interleave(self, fields):
+        width = max(map(len, fields))
+        # Write each padded field into every nth slot of a list of
+        # characters.
+        chars = [None] * (width * self.length)
+        for i, field in enumerate(fields):
+            chars[i::self.length] = field.ljust(width, '\1')
+        return ''.join(chars)
+
+    def _inflate(self, bts):
         if len(bts) == 0:
             return tuple(['']*self.length)
-        seq = [("".join(g)).strip('\1')
-               for g in zip(*take_n_by_n(bts, n=self.length))]
-        tup = tuple(c.inflate(x) for c, x in zip(self.itemserializers, seq))
-        print(bts, seq, tup)
-        return tup
-
-
-def take_n_by_n(t, n):
-    args = [iter(t)] * n
-    return zip(*args)
-
-def braces_balanced(string):
-    brace = False
-    for c in string:
-        if c == '[':
-            if brace:
-                return False
-            else:
-                brace = True
-        elif c == ']':
-            if not brace:
-                return False
-            else:
-                brace = False
-    if not brace:
-        return True
-    return False
+        return tuple(c.inflate(bts[i::self.length].strip('\1'))
+                     for i, c in enumerate(self.itemserializers))
+
+
+def describe_prototype(prototype):
+    if isinstance(prototype, six.text_type):
+        return "str"
+    if isinstance(prototype, six.binary_type):
+        return "bytes"
+    return [describe_prototype(x) for x in prototype]
+
+def prototype_from_description(description):
+    if description == "str":
+        return ""
+    if description == "bytes":
+        return b""
+    if isinstance(description, list):
+        return tuple(prototype_from_description(d) for d in description)
+    raise ValueError("Unknown serializer description %r" % (description,))
+
+# Strings with no null or \1 characters, in which every "[" is closed by a
+# "]" before the next "[", and no "]" comes without one.
+_VALID = re.compile(r"[^\[\]\0\1]*(?:\[[^\[\]\0\1]*\][^\[\]\0\1]*)*\Z")
+# The same for a batch of strings joined with null bytes, which must not
+# fall inside braces.
+_VALID_JOINED = re.compile(r"[^\[\]\1]*(?:\[[^\[\]\0\1]*\][^\[\]\1]*)*\Z")
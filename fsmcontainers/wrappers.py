@@ -3,89 +3,99 @@
 # TODO: top/bottom rather than key/value terminology
 
 import collections
+import functools
+import hashlib
 import six
 import operator
 import pynini
 import pywrapfst
 from .serializers import Serializer
+from .engine import EngineWrapper, countPaths, findAmbiguousPath, \
+                    reachesFinal, intersects, includedIn
+from .builders import MinimalAcyclicBuilder
 
-NotImplemented = False
 
-class EngineWrapper(object):
-    def __init__(self, contents):
-        return NotImplemented
+# Properties of a wrapped machine that are worth knowing to skip work.
+OPTIMIZED = "optimized"          # As left by Fst.optimize().
+ARCSORTED = "arcsorted"          # Arcs sorted by input label.
+EPSFREE = "epsfree"              # No arcs with epsilon on both sides.
+DETERMINISTIC = "deterministic"  # No two arcs leave a state with one label.
 
-    def __eq__(self, other):
-        return NotImplemented
-
-    def accepts(self, item, side="top"):
-        return NotImplemented
-
-    def apply(self, item, direction="down"):
-        return NotImplemented
-
-    def pathIterator(self, limit=None, side=None):
-        return NotImplemented
-
-    def concatenate(self, other):
-        return NotImplemented
-
-    def union(self, other):
-        return NotImplemented
-
-    def priorityUnion(self, other):
-        return NotImplemented
-
-    def intersect(self, other):
-        return NotImplemented
-
-    def subtract(self, other):
-        return NotImplemented
-
-    def compose(self, other):
-        return NotImplemented
+_OPTIMIZED = frozenset([OPTIMIZED, EPSFREE])
 
-    def lenientlyCompose(self, other):
-        return NotImplemented
-
-    def project(self, other, side):
-        return NotImplemented
-
-    def star(self):
-        return NotImplemented
+def _constructiveOp(op, combineLabels=None):
+    def innerFunction(self, other):
+        cls = type(self)
+        return cls(op(self.fsm, other.fsm),
+                   _combineLabels(combineLabels, self, other))
+    return innerFunction
 
-    def plus(self):
-        return NotImplemented
+def _combineLabels(combine, *wrappers):
+    """ Return the alphabet of the result of an operation on *wrappers*,
+    worked out by *combine* from theirs, or None if any is unknown. """
+    if combine is None or any(w.labels is None for w in wrappers):
+        return None
+    return combine(*(w.labels for w in wrappers))
+
+def _foldLabels(combine, labels, other):
+    """ Return the alphabet of a partial result, *labels*, combined by
+    *combine* with that of its next operand, *other*, or None if either is
+    unknown. Folding alphabets in one operand at a time means the operands
+    need not be kept for working out the alphabet at the end. """
+    if labels is None or other is None:
+        return None
+    return combine(labels, other)
 
-    def sigma(self):
-        return NotImplemented
+def _unionLabels(*alphabets):
+    return (frozenset().union(*(i for i, _ in alphabets)),
+            frozenset().union(*(o for _, o in alphabets)))
 
-    def makeRewrite(self, 
-                    leftEnvironment=None, rightEnvironment=None,
-                    leftBottomTape=False, rightBottomTape=False):
-        return NotImplemented
+def _composeLabels(first, second):
+    return (first[0], second[1])
 
-    def findAmbiguity(self, strictness):
-        return NotImplemented
+def _intersectLabels(first, second):
+    return (first[0] & second[0], first[1] & second[1])
 
+def _leftLabels(first, second):
+    return first
 
-def _constructiveOp(op):
-    def innerFunction(self, other):
-        cls = type(self)
-        return cls(op(self.fsm, other.fsm))
-    return innerFunction
+def _lenientLabels(first, second):
+    return (first[0], first[1] | second[1])
 
 class PyniniWrapper(EngineWrapper):
-    def __init__(self, fsm):
+    """ Wraps a Pynini machine. Wrappers are never modified once built, nor
+    are the machines inside them, so they can be shared freely between
+    containers and threads; operations always return new wrappers. """
+
+    def __init__(self, fsm, labels=None, properties=()):
         self.fsm = fsm
+        self.properties = frozenset(properties) # What is known to hold of
+                                                # fsm; see OPTIMIZED etc.
+        self.labels = labels    # (input labels, output labels) that may
+                                # appear in fsm, carried through operations
+                                # so that alphabet() need not scan for
+                                # them. None if not known yet.
+        self.lookupCache = None # Set by fsmcontainer.enable_cache(). Lives
+                                # on the wrapper so that it is discarded
+                                # along with the machine it describes.
+        self.arcIndex = None    # Set by freeze().
+        self.pathCount = None   # Cached by numPaths().
+        self.canonicalForm = None # Cached by canonical().
+        self.optimizedForm = None # Cached by optimized().
+        self.digest = None      # Cached by fingerprint().
 
     @classmethod
-    def fromPairs(cls, pairs):
+    def fromPairs(cls, pairs, validated=False):
+        """ Build a machine from (input, output) string pairs. Pass
+        *validated* if the strings are already known to be free of null
+        bytes, as they are when they come from a serializer. """
+        inputs, outputs = _LabelRecorder(), _LabelRecorder()
         fsm = pynini.string_map(
-                cls.encodePairs(pairs), 
+                ((inputs.add(k), outputs.add(v)) for k, v in
+                 (pairs if validated else cls.encodePairs(pairs))),
                 input_token_type="utf8",
                 output_token_type="utf8")
-        return cls(fsm)
+        return cls(fsm, (inputs.labels(), outputs.labels()))
 
     @classmethod
     def encodePairs(cls, pairs):
@@ -95,20 +105,120 @@ class PyniniWrapper(EngineWrapper):
             yield (k, v)
 
     @classmethod
-    def fromItems(cls, items):
-        pairs = cls.encodePairs(zip(items, items))
-        return cls.fromPairs(pairs)
+    def fromWeightedPairs(cls, triples, validated=False):
+        """ Build a machine from (input, output, weight) triples, as
+        :meth:`fromPairs` does from pairs. Weights are costs in the tropical
+        semiring: a path costs the sum of the weights along it, and the
+        cheapest paths are the best ones. Weights must be finite. """
+        inputs, outputs = _LabelRecorder(), _LabelRecorder()
+        fsm = pynini.string_map(
+                ((inputs.add(k), outputs.add(v), str(_weight(w)))
+                 for k, v, w in
+                 (triples if validated else cls.encodeTriples(triples))),
+                input_token_type="utf8",
+                output_token_type="utf8")
+        return cls(fsm, (inputs.labels(), outputs.labels()))
+
+    @classmethod
+    def encodeTriples(cls, triples):
+        for k, v, w in triples:
+            if "\x00" in k or "\x00" in v:
+                raise ValueError
+            yield (k, v, w)
+
+    @classmethod
+    def fromItems(cls, items, validated=False):
+        return cls.fromPairs(((i, i) for i in items), validated)
 
     @classmethod
-    def fromItem(cls, item):
-        pairs = cls.encodePairs([(item, item)])
-        return cls.fromPairs(pairs)
+    def fromItem(cls, item, validated=False):
+        return cls.fromPairs([(item, item)], validated)
 
     @classmethod
     def fromFilename(cls, filename):
         fsm = pynini.Fst.read(filename)
         return cls(fsm)
 
+    @classmethod
+    def fromString(cls, string, frozen=False):
+        """ Load a machine from the binary string produced by
+        :meth:`toString`. """
+        if frozen:
+            obj = cls(pynini.Fst.read_from_string(string),
+                      properties=_OPTIMIZED | {ARCSORTED})
+            obj.arcIndex = _ArcIndex(obj.fsm)
+        else:
+            obj = cls(pynini.Fst.read_from_string(string))
+        return obj
+
+    def toString(self):
+        """ Return this machine in OpenFST's binary format. """
+        return self.fsm.write_to_string()
+
+    def __reduce__(self):
+        # Pickle as OpenFST binary. Lookup caches and arc indexes are not
+        # sent; a frozen machine rebuilds its index as it is used.
+        return (type(self).fromString, (self.toString(), self.frozen))
+
+    @classmethod
+    def fromSortedPairs(cls, pairs, acceptor=False, progress=None,
+                        progressEvery=100000):
+        """ Build the minimal acyclic machine for *pairs* incrementally. For
+        an acceptor only the first string of each pair is used; for a
+        transducer, each key is read before its value is written. The pairs
+        must be sorted by the labels they compile to, which for strings with
+        no bracketed tokens means ordinary sorted order. If given,
+        *progress* is called with the number of pairs read so far every
+        *progressEvery* pairs and once at the end. """
+        builder = MinimalAcyclicBuilder()
+        labels = cls.stringLabels
+        for count, (k, v) in enumerate(pairs, 1):
+            if acceptor:
+                builder.add(labels(k))
+            else:
+                builder.add([(l, 0) for l in labels(k)] +
+                            [(0, l) for l in labels(v)])
+            if progress is not None and count % progressEvery == 0:
+                progress(count)
+        if progress is not None:
+            progress(builder.count)
+        states, root = builder.finish()
+        return cls.fromAcyclicStates(states, root)
+
+    @classmethod
+    def fromAcyclicStates(cls, states, root):
+        """ Build a machine from states as returned by
+        :meth:`MinimalAcyclicBuilder.finish`. """
+        reference = cls.fromPairs([]).fsm # For matching symbol tables.
+        fsm = pynini.Fst()
+        fsm.set_input_symbols(reference.input_symbols())
+        fsm.set_output_symbols(reference.output_symbols())
+        one = pynini.Weight.One(fsm.weight_type())
+        last = len(states) - 1
+        inputs, outputs = set(), set()
+        for _ in states:
+            fsm.add_state()
+        # Number the states in reverse, so that the start state is 0.
+        fsm.set_start(last - root)
+        for index, (final, arcs) in enumerate(states):
+            state = last - index
+            if final:
+                fsm.set_final(state, one)
+            for label, target in arcs:
+                ilabel, olabel = label if isinstance(label, tuple) \
+                                       else (label, label)
+                fsm.add_arc(state, pynini.Arc(ilabel, olabel, one,
+                                              last - target))
+                inputs.add(ilabel)
+                outputs.add(olabel)
+        # The minimal acyclic machine over (input, output) pairs is what
+        # optimize() would produce.
+        acceptor = not any(isinstance(label, tuple)
+                           for _, arcs in states for label, _ in arcs)
+        properties = _OPTIMIZED | ({DETERMINISTIC} if acceptor else set())
+        return cls(fsm, (frozenset(inputs - {0}), frozenset(outputs - {0})),
+                   properties)
+
     @classmethod
     def transducer(cls, fsm1, fsm2):
         if not isinstance(fsm1, cls):
@@ -116,14 +226,136 @@ class PyniniWrapper(EngineWrapper):
         if not isinstance(fsm2, PyniniWrapper):
             fsm2 = PyniniWrapper.fromItem(fsm2)
         fsm = pynini.transducer(fsm1.fsm, fsm2.fsm)
-        return cls(fsm)
+        return cls(fsm, _combineLabels(_composeLabels, fsm1, fsm2))
 
     def __eq__(self, other):
-        em = pynini.EncodeMapper("standard", True, True)
-        return pynini.equivalent(pynini.encode(self.fsm, em).optimize(), 
-                                 pynini.encode(other.fsm, em).optimize())
+        return self.fingerprint() == other.fingerprint()
+
+    def canonical(self):
+        """ Return the canonical form of this machine: the minimal
+        deterministic machine over (input, output, weight) triples, with its
+        states numbered in breadth-first order from the start state and the
+        arcs of each state sorted. Acyclic machines are synchronized first,
+        so that outputs are lined up with inputs the same way however the
+        machine was built, and weighted ones have their weights pushed
+        toward the start state, so that weights are spread along paths the
+        same way too. Two acyclic machines have the same canonical form
+        exactly when they are equivalent; two cyclic ones may fail to if
+        they are weighted, since they cannot always be determinized before
+        their weights are pushed. The result is computed once and kept. """
+        if self.canonicalForm is None:
+            acyclic = self.numPaths() != float('inf')
+            if acyclic:
+                fsm = pynini.synchronize(self.fsm)
+            else:
+                fsm = self.fsm.copy()
+            fsm.rmepsilon()
+            if fsm.properties(pynini.WEIGHTED, True) == pynini.WEIGHTED:
+                fsm = _pushWeights(fsm, determinize=acyclic)
+            em = pynini.EncodeMapper("standard", True, True)
+            encoded = pynini.encode(fsm, em).optimize()
+            self.canonicalForm = _renumber(pynini.decode(encoded, em))
+        return self.canonicalForm
+
+    def fingerprint(self):
+        """ Return a SHA-256 hex digest of the canonical form of this
+        machine, which is the same for equivalent machines, in this process
+        or any other, and almost certainly different otherwise. """
+        if self.digest is None:
+            fsm = self.canonical()
+            top = labelDecoder(fsm.input_symbols())
+            bottom = labelDecoder(fsm.output_symbols())
+            zero = pynini.Weight.Zero(fsm.weight_type())
+            digest = hashlib.sha256(fsm.weight_type().encode("utf8"))
+            for state in fsm.states():
+                final = fsm.final(state)
+                lines = ["state %s" % (final if final != zero else "")]
+                for arc in fsm.arcs(state):
+                    lines.append("%r %r %s %d" % (top[arc.ilabel],
+                                                  bottom[arc.olabel],
+                                                  arc.weight, arc.nextstate))
+                digest.update("\n".join(lines).encode("utf8") + b"\n")
+            self.digest = digest.hexdigest()
+        return self.digest
+
+    @property
+    def frozen(self):
+        return self.arcIndex is not None
+
+    def optimized(self):
+        """ Return an optimized equivalent of this machine: this wrapper if
+        it is known to be optimized already, and otherwise a copy that is
+        optimized the first time it is asked for and kept. """
+        if OPTIMIZED in self.properties:
+            return self
+        if self.optimizedForm is None:
+            cls = type(self)
+            self.optimizedForm = cls(self.fsm.copy().optimize(), self.labels,
+                                     _OPTIMIZED)
+        return self.optimizedForm
+
+    def freeze(self):
+        """ Return a read-only copy of this machine prepared for lookups:
+        epsilon-removed, determinized where possible, arc-sorted, and
+        indexed so that lookups walk its transitions directly instead of
+        composing. """
+        cls = type(self)
+        fsm = self.optimized().fsm.copy()
+        fsm.arcsort(sort_type="ilabel")
+        obj = cls(fsm, self.labels, self.optimized().properties | {ARCSORTED})
+        obj.arcIndex = _ArcIndex(fsm)
+        obj.canonicalForm, obj.digest = self.canonicalForm, self.digest
+        return obj
+
+    @classmethod
+    def stringLabels(cls, string):
+        """ Return the sequence of arc labels that *string* is compiled to. """
+        if "[" not in string and "\\" not in string:
+            return [ord(c) for c in string]
+        # Bracketed multi-character tokens and escapes: let Pynini parse them.
+        fsm = pynini.acceptor(string, token_type="utf8")
+        labels = []
+        state = fsm.start()
+        while fsm.num_arcs(state):
+            arc = next(iter(fsm.arcs(state)))
+            if arc.ilabel:
+                labels.append(arc.ilabel)
+            state = arc.nextstate
+        return labels
+
+    @classmethod
+    def normalizeString(cls, string):
+        """ Return *string* as it reads back from a machine it is compiled
+        into: with escapes resolved, single-character tokens unbracketed
+        and multi-character tokens left in brackets. """
+        if "[" not in string and "\\" not in string:
+            return string
+        fsm = pynini.acceptor(string, token_type="utf8")
+        return labelDecoder(fsm.input_symbols()).decode(
+                cls.stringLabels(string))
+
+    def _walk(self, item):
+        """ Return the (state, output labels) configurations of a frozen
+        machine that are reached by reading *item* from its start state. """
+        index = self.arcIndex
+        if index.start < 0:
+            return set()
+        configs = index.closure({(index.start, ())})
+        for label in self.stringLabels(item):
+            step = set()
+            for state, output in configs:
+                for olabel, nextstate in index.arcs(state).get(label, ()):
+                    step.add((nextstate, output + (olabel,) if olabel
+                                         else output))
+            if not step:
+                return step
+            configs = index.closure(step)
+        return configs
 
     def accepts(self, item, side="top"):
+        if self.frozen and side == "top":
+            return any(self.arcIndex.isFinal(state)
+                       for state, _ in self._walk(item))
         cls = type(self)
         wrappedItem = cls.fromPairs([(item, item)])
         if side == "top":
@@ -133,92 +365,303 @@ class PyniniWrapper(EngineWrapper):
         paths = product.pathIterator(limit=1)
         return len(list(paths)) == 1
 
-    def pathIterator(self, limit=None, side=None):
+    def acceptsMany(self, items, side="top"):
+        """ Return the set of strings from *items* that this machine accepts
+        on *side*, building and composing a single machine for the whole
+        batch rather than one per item. """
+        if self.frozen and side == "top":
+            return {item for item in items if self.accepts(item)}
+        cls = type(self)
+        spellings = cls._spellings(items)
+        batch = cls.fromItems([spelled[0] for spelled in spellings.values()])
+        if side == "top":
+            product = batch.compose(self)
+        else:
+            product = self.compose(batch)
+        return {item for string in product.pathIterator(side=side)
+                     for item in spellings.get(string, ())}
+
+    def lookupMany(self, items):
+        """ Yield an (input, output) pair for every path this machine has
+        from any of the strings in *items*. The whole batch is composed
+        with this machine at once, so the setup cost is paid once per batch
+        rather than once per item. """
+        if self.frozen:
+            return ((item, value) for item in dict.fromkeys(items)
+                                  for value in self.lookup(item))
+        cls = type(self)
+        spellings = cls._spellings(items)
+        batch = cls.fromItems([spelled[0] for spelled in spellings.values()])
+        return ((item, value)
+                for key, value in batch.compose(self).pathIterator(side="both")
+                for item in spellings.get(key, ()))
+
+    @classmethod
+    def _spellings(cls, items):
+        """ Return a dictionary from each of the distinct strings in *items*,
+        as a machine reads it back, to the ways it is spelled in *items*, so
+        that results read back from a machine can be given to the caller as
+        they were asked for. """
+        spellings = {}
+        for item in dict.fromkeys(items):
+            spellings.setdefault(cls.normalizeString(item), []).append(item)
+        return spellings
+
+    def lookup(self, item):
+        """ Return a list of the strings that this machine maps *item* to. """
+        if not self.frozen:
+            return [value for _, value in self.lookupMany([item])]
+        index = self.arcIndex
+        return list({index.decode(output)
+                     for state, output in self._walk(item)
+                     if index.isFinal(state)})
+
+    def bestLookup(self, item, limit):
+        """ Return (output, weight) pairs for the *limit* cheapest distinct
+        strings that this machine maps *item* to, cheapest first. Only the
+        best paths are searched for: an output reached along several paths
+        costs as much as the cheapest of them, and the rest are pruned
+        without being listed. """
+        outputs = type(self).fromItem(item).compose(self).project("bottom")
+        fsm = pynini.shortestpath(outputs.fsm.rmepsilon(), nshortest=limit,
+                                  unique=True)
+        decode = labelDecoder(fsm.output_symbols()).decode
+        found = []
+        paths = fsm.paths()
+        while not paths.done():
+            found.append((decode(paths.olabels()),
+                          float(str(paths.weight()))))
+            paths.next()
+        return sorted(found, key=lambda pair: (pair[1], pair[0]))
+
+    def labelPaths(self, limit=None):
+        """ Yield an (input labels, output labels) pair of tuples for every
+        path through this machine, or for the *limit* shortest paths. Labels
+        are yielded raw, epsilons included, for decoding with
+        :func:`labelDecoder`. """
+        fsm = self.optimized().fsm # Each string once, however the machine
+                                   # was put together.
         if limit is None:
             try:
-                stringpaths = self.fsm.paths(
-                    input_token_type='symbol',
-                    output_token_type='symbol')
+                paths = fsm.paths()
             except pywrapfst.FstArgError:
                 print("Can't iterate over this mapping. It is cyclic and may accept infinitely many keys.")
                 raise
         else:
-            stringpaths = pynini.shortestpath(self.fsm, nshortest=limit).paths(
-                input_token_type='symbol',
-                output_token_type='symbol')
+            paths = pynini.shortestpath(fsm, nshortest=limit).paths()
+        while not paths.done():
+            yield tuple(paths.ilabels()), tuple(paths.olabels())
+            paths.next()
+
+    def pathIterator(self, limit=None, side=None):
+        top = labelDecoder(self.fsm.input_symbols()).decode
+        bottom = labelDecoder(self.fsm.output_symbols()).decode
+        labelPaths = self.labelPaths(limit)
         if side=="top":
-            for stringpath in stringpaths:
-                yield pynini_decode(stringpath[0])
+            for ilabels, _ in labelPaths:
+                yield top(ilabels)
         elif side=="bottom":
-            for stringpath in stringpaths:
-                yield pynini_decode(stringpath[1])
+            for _, olabels in labelPaths:
+                yield bottom(olabels)
         else:
-            for stringpath in stringpaths:
-                yield (pynini_decode(stringpath[0]),
-                       pynini_decode(stringpath[1]))
-
-    concatenate = _constructiveOp(pynini.concat)
+            for ilabels, olabels in labelPaths:
+                yield (top(ilabels), bottom(olabels))
+
+    concatenate = _constructiveOp(pynini.concat, _unionLabels)
+
+    def numPaths(self):
+        """ Return the number of paths through the optimized form of this
+        machine, or :literal:`float('inf')` if it is cyclic. """
+        if self.pathCount is None:
+            fsm = self.optimized().fsm
+            zero = pynini.Weight.Zero(fsm.weight_type())
+            self.pathCount = countPaths(
+                    fsm.start(),
+                    lambda state: [arc.nextstate for arc in fsm.arcs(state)],
+                    lambda state: fsm.final(state) != zero)
+        return self.pathCount
 
     def numPathsCompare(self, n, op=operator.eq):
-        numToTryFor = n+1
-        numFound = len(list(self.pathIterator(limit=numToTryFor)))
-        return op(numFound, n)
+        return op(self.numPaths(), n)
+
+    def alphabet(self):
+        """ Return the sets of labels, other than epsilon, that may appear on
+        the input and the output side of this machine. These are worked out
+        when the machine is built and carried through operations on it, so
+        after a composition or intersection they may include labels that
+        are no longer used. Only machines read from elsewhere are scanned,
+        once. """
+        if self.labels is None:
+            inputs, outputs = set(), set()
+            for state in self.fsm.states():
+                for arc in self.fsm.arcs(state):
+                    inputs.add(arc.ilabel)
+                    outputs.add(arc.olabel)
+            self.labels = (frozenset(inputs - {0}), frozenset(outputs - {0}))
+        return self.labels
+
+
+    def alphabetSymbols(self):
+        """ Return the sets of strings that the labels given by
+        :meth:`alphabet` stand for. Unlike labels for bracketed tokens,
+        which Pynini may number differently in every process, these mean
+        the same anywhere. """
+        inputs, outputs = self.alphabet()
+        top = labelDecoder(self.fsm.input_symbols())
+        bottom = labelDecoder(self.fsm.output_symbols())
+        return (frozenset(top[label] for label in inputs),
+                frozenset(bottom[label] for label in outputs))
+    def stats(self):
+        return {
+            "states": self.fsm.num_states(),
+            "arcs": sum(self.fsm.num_arcs(s) for s in self.fsm.states()),
+            "paths": self.numPaths(),
+        }
 
     def isCyclic(self):
-        try: 
-            stringpaths = self.fsm.paths()
-        except pywrapfst.FstArgError:
-            return True
-        return False
+        return self.numPaths() == float('inf')
+
+    def isWeighted(self):
+        """ Return True if any arc or final state has a weight other than
+        the semiring's one. """
+        return self.fsm.properties(pynini.WEIGHTED, True) == pynini.WEIGHTED
 
     def hasPaths(self):
-        return self.numPathsCompare(0, operator.gt)
+        return reachesFinal(self.transitions())
+
+    def transitions(self):
+        """ Return (start, arcs, isFinal) for searching this machine state
+        by state, as the search functions in :mod:`fsmcontainers.engine`
+        expect. Arcs are read from the machine as states are visited. """
+        index = self.arcIndex or _ArcIndex(self.fsm)
+        return (index.start, index.arcs, index.isFinal)
+
+    def isDisjoint(self, other):
+        """ Return True if this acceptor and *other* have no string in
+        common, without building their intersection. """
+        return not intersects(self.transitions(), other.transitions())
+
+    def isSubset(self, other):
+        """ Return True if every string this acceptor accepts is accepted by
+        *other*, without building their difference. """
+        return includedIn(self.transitions(), other.transitions())
 
     def intersect(self, other):
-        self.fsm.optimize() # Pynini intersection will fail on unoptimized FSAs
-        return _constructiveOp(pynini.intersect)(self, other)
+        # Pynini intersection will fail on unoptimized FSAs.
+        cls = type(self)
+        return cls(pynini.intersect(self.optimized().fsm, other.optimized().fsm),
+                   _combineLabels(_intersectLabels, self, other))
 
-    def union(self, other):
-        obj = _constructiveOp(pynini.union)(self, other)
-        obj.fsm.optimize() # Counting paths is inaccurate after union unless
-                           # we do this. TODO: more robust solution.
-        return obj
+    # Unions aren't optimized: paths are counted and listed from the
+    # optimized form, which is only built if it is needed.
+    union = _constructiveOp(pynini.union, _unionLabels)
 
     priorityUnion = _constructiveOp(...)
 
-    subtract = _constructiveOp(pynini.difference)
-    compose = _constructiveOp(pynini.compose)
-    lenientlyCompose = _constructiveOp(pynini.leniently_compose)
+    @classmethod
+    def unionAll(cls, wrappers):
+        """ Return the union of all of *wrappers*, optimized once at the end
+        rather than after every step. Operands are unioned into the result in
+        place one at a time, so *wrappers* may be a generator and no
+        intermediate results are kept. """
+        return cls._foldInPlace(wrappers, lambda fsm, other: fsm.union(other),
+                                _unionLabels)
+
+    @classmethod
+    def concatenateAll(cls, wrappers):
+        """ Return the concatenation of all of *wrappers* in order, built the
+        same way as :meth:`unionAll`. """
+        return cls._foldInPlace(wrappers, lambda fsm, other: fsm.concat(other),
+                                _unionLabels)
+
+    @classmethod
+    def _foldInPlace(cls, wrappers, op, combineLabels):
+        fsm = labels = None
+        for wrapper in wrappers:
+            if fsm is None:
+                fsm = wrapper.fsm.copy()
+                labels = wrapper.labels
+            else:
+                op(fsm, wrapper.fsm)
+                labels = _foldLabels(combineLabels, labels, wrapper.labels)
+        if fsm is None:
+            return cls.fromPairs([])
+        return cls(fsm.optimize(), labels, _OPTIMIZED)
+
+    @classmethod
+    def intersectAll(cls, wrappers):
+        """ Return the intersection of all of *wrappers*. Each operand is
+        optimized on its own, as Pynini requires, but intermediate products
+        are not; the result is optimized once at the end. """
+        fsm = labels = None
+        for wrapper in wrappers:
+            operand = wrapper.optimized().fsm
+            if fsm is None:
+                fsm, labels = operand, wrapper.labels
+            else:
+                fsm = pynini.intersect(fsm, operand)
+                labels = _foldLabels(_intersectLabels, labels, wrapper.labels)
+        if fsm is None:
+            raise ValueError("Intersection of no machines is undefined.")
+        return cls(fsm.optimize(), labels, _OPTIMIZED)
+
+    def subtractAll(self, wrappers):
+        """ Return this machine minus every one of *wrappers*, computed as a
+        single difference with the union of the *wrappers*. """
+        cls = type(self)
+        return self.subtract(cls.unionAll(wrappers))
+
+    def subtract(self, other):
+        # The machine subtracted must be an epsilon-free deterministic
+        # acceptor, which an optimized acceptor is.
+        cls = type(self)
+        return cls(pynini.difference(self.fsm, other.optimized().fsm),
+                   _combineLabels(_leftLabels, self, other))
+
+    compose = _constructiveOp(pynini.compose, _composeLabels)
+    lenientlyCompose = _constructiveOp(pynini.leniently_compose, _lenientLabels)
 
     def project(self, side="top"):
         if side not in {"top", "bottom"}:
             raise ValueError
         tf = (side == "bottom")
         cls = type(self)
-        return cls(self.fsm.copy().project(project_output=tf))
+        labels = None
+        if self.labels is not None:
+            labels = (self.labels[tf],) * 2
+        return cls(self.fsm.copy().project(project_output=tf), labels)
 
     def cross(self, other):
         cls = type(self)
-        return cls(pynini.transducer(self.fsm, other.fsm))
+        return cls(pynini.transducer(self.fsm, other.fsm),
+                   _combineLabels(_composeLabels, self, other))
 
     def star(self):
         cls = type(self)
-        return cls(pynini.closure(self.fsm).optimize())
+        return cls(pynini.closure(self.fsm), self.labels)
 
     def plus(self):
         cls = type(self)
-        return cls(pynini.closure(self.fsm, 1).optimize()) #TEST THIS
+        return cls(pynini.closure(self.fsm, 1), self.labels) #TEST THIS
 
     def sigma(self):
-        sigma = set()
-        isyms = self.fsm.input_symbols()
-        osyms = self.fsm.output_symbols()
-        for state in self.fsm.states():
-            for arc in self.fsm.arcs(state):
-                sigma |= {pynini_decode(isyms.find(arc.ilabel))}
-                sigma |= {pynini_decode(osyms.find(arc.olabel))}
-        cls = type(self)
-        return cls.fromPairs((s,s) for s in sigma if "\x00" not in s)
+        """ Return an acceptor for the single symbols in this machine's
+        alphabet, on either side. """
+        inputs, outputs = self.alphabet()
+        return type(self).fromLabels(inputs | outputs)
+
+    @classmethod
+    def fromLabels(cls, labels):
+        """ Return an acceptor for the single symbols *labels*. Acceptors
+        are shared between calls with the same labels, so must not be
+        modified in place. """
+        return _symbolAcceptor(cls, frozenset(labels))
+
+    @classmethod
+    def sigmaStar(cls, labels):
+        """ Return an acceptor for every string of the symbols *labels*,
+        shared in the same way as :meth:`fromLabels`. """
+        return _symbolStar(cls, frozenset(labels))
 
     def makeRewrite(self, 
                     leftEnvironment=None, rightEnvironment=None,
@@ -227,38 +670,232 @@ class PyniniWrapper(EngineWrapper):
         cls = type(self)
         left = leftEnvironment or cls.fromItem("")
         right = rightEnvironment or cls.fromItem("")
-        sigma = sigma or (self.sigma()
-                          .union(left.sigma())
-                          .union(right.sigma())
-                          .star())
+        if sigma is None:
+            inputs, outputs = _unionLabels(self.alphabet(), left.alphabet(),
+                                           right.alphabet())
+            sigma = cls.sigmaStar(inputs | outputs)
         fsm = pynini.cdrewrite(self.fsm, left.fsm, right.fsm, sigma.fsm)
-        return cls(fsm)
+        return cls(fsm, _combineLabels(_unionLabels, self, sigma))
+
+    def findAmbiguity(self, maxStates=100000, timeout=None):
+        """ Return an input that this machine maps to two different outputs,
+        as a triple (input, output, other output), or None if there is no
+        such input. The test is exact; see :func:`findAmbiguousPath` for
+        the method and the meaning of *maxStates* and *timeout*. """
+        # The optimized machine has far fewer pairs of states to visit.
+        index = self.arcIndex or _ArcIndex(self.optimized().fsm)
+        witness = findAmbiguousPath(index.start, index.arcs, index.isFinal,
+                                    maxStates, timeout)
+        if witness is None:
+            return None
+        inputs, output, other = witness
+        return (labelDecoder(self.fsm.input_symbols()).decode(inputs),
+                index.decode(output), index.decode(other))
+
+    def isFunctional(self, maxStates=100000, timeout=None):
+        return self.findAmbiguity(maxStates, timeout) is None
+
+
+def _weight(w):
+    """ Return *w* as a finite float, or raise ValueError. """
+    w = float(w)
+    if w != w or w in (float("inf"), float("-inf")):
+        raise ValueError("Weights must be finite numbers, not %r." % w)
+    return w
+
+def _pushWeights(fsm, determinize):
+    """ Return *fsm* with its weights pushed toward the start state, after
+    determinizing it as an acceptor of label pairs if *determinize* is true,
+    so that equivalent machines spread their weights the same way. """
+    em = pynini.EncodeMapper("standard", True, False)
+    encoded = pynini.encode(fsm, em)
+    if determinize:
+        encoded = pynini.determinize(encoded)
+    return pynini.decode(pynini.push(encoded, push_weights=True), em)
+
+def _renumber(fsm):
+    """ Return a copy of *fsm*, which must be deterministic, with its states
+    numbered in breadth-first order from the start state and each state's
+    arcs sorted by the symbols on them. Labels themselves aren't used, since
+    Pynini may number generated symbols differently in another process. """
+    top = labelDecoder(fsm.input_symbols())
+    bottom = labelDecoder(fsm.output_symbols())
+    result = pynini.Fst(fsm.arc_type())
+    result.set_input_symbols(fsm.input_symbols())
+    result.set_output_symbols(fsm.output_symbols())
+    if fsm.start() < 0:
+        return result
+    order = {fsm.start(): result.add_state()}
+    queue = collections.deque([fsm.start()])
+    while queue:
+        state = queue.popleft()
+        arcs = sorted(fsm.arcs(state),
+                      key=lambda arc: (top[arc.ilabel], bottom[arc.olabel],
+                                       str(arc.weight)))
+        for arc in arcs:
+            if arc.nextstate not in order:
+                order[arc.nextstate] = result.add_state()
+                queue.append(arc.nextstate)
+            result.add_arc(order[state], pynini.Arc(
+                    arc.ilabel, arc.olabel, arc.weight, order[arc.nextstate]))
+        result.set_final(order[state], fsm.final(state))
+    result.set_start(0)
+    return result
+
+@functools.lru_cache(maxsize=256)
+def _symbolAcceptor(cls, labels):
+    states = [(True, ()), (False, tuple((label, 0) for label in sorted(labels)))]
+    return cls.fromAcyclicStates(states, 1)
+
+@functools.lru_cache(maxsize=256)
+def _symbolStar(cls, labels):
+    return _symbolAcceptor(cls, labels).star().optimized()
+
+
+class _LabelRecorder(object):
+    """ Collects the labels of the strings passed to :meth:`add`, which
+    returns each string unchanged. """
+
+    def __init__(self):
+        self.chars = set()
+        self.tokens = set()
+
+    def add(self, string):
+        if "[" in string or "\\" in string:
+            self.tokens.update(PyniniWrapper.stringLabels(string))
+        else:
+            self.chars.update(string)
+        return string
 
-    def findAmbiguity(self, strictness=100):
-        """ Allauzen and Mohri: an FST f is functional (i.e. one-to-one or
-        many-to-one) iff f' .o. f is the identity function over f's domain.
-        Rather than implement A&Z's algorithm to determine strict identity,
-        we test identity for a random sample of paths.
-        """
-        fpcf = self.fsm.copy().invert() * self.fsm
-        for top, bottom, _ in pynini.randgen(fpcf,
-                                             npath=strictness,
-                                             max_length=strictness)\
-                                    .paths(input_token_type="symbol",
-                                           output_token_type="symbol"):
-            if top != bottom:
-                return (clean(top), clean(bottom))
-        return None
+    def labels(self):
+        return frozenset(map(ord, self.chars)) | self.tokens
+
+
+class _ArcIndex(object):
+    """ Table of the arcs leaving each state of an FSM, grouped by input
+    label, for walking the machine one symbol at a time. Each state's entry is
+    built the first time the state is visited. """
+
+    def __init__(self, fsm):
+        self.fsm = fsm
+        self.start = fsm.start()
+        self.zero = pynini.Weight.Zero(fsm.weight_type())
+        self.decode = labelDecoder(fsm.output_symbols()).decode
+        self._arcs = {}
+        self._finals = {}
+
+    def arcs(self, state):
+        table = self._arcs.get(state)
+        if table is None:
+            table = {}
+            for arc in self.fsm.arcs(state):
+                table.setdefault(arc.ilabel, []).append(
+                        (arc.olabel, arc.nextstate))
+            self._arcs[state] = table
+        return table
+
+    def isFinal(self, state):
+        final = self._finals.get(state)
+        if final is None:
+            final = self._finals[state] = self.fsm.final(state) != self.zero
+        return final
+
+    def closure(self, configs):
+        """ Extend a set of (state, output labels) configurations with every
+        configuration reachable from them by input-epsilon arcs. """
+        result = set(configs)
+        stack = [(state, output, {state: len(output)})
+                 for state, output in configs]
+        while stack:
+            state, output, onPath = stack.pop()
+            for olabel, nextstate in self.arcs(state).get(0, ()):
+                nextoutput = output + (olabel,) if olabel else output
+                if nextstate in onPath:
+                    if onPath[nextstate] < len(nextoutput):
+                        raise ValueError(
+                            "Input maps to infinitely many outputs.")
+                    continue
+                if (nextstate, nextoutput) not in result:
+                    result.add((nextstate, nextoutput))
+                    stack.append((nextstate, nextoutput,
+                                  {**onPath, nextstate: len(nextoutput)}))
+        return result
+
+
+
+class LabelDecoder(dict):
+    """ Table from the labels of a machine to the strings they stand for,
+    filled in as labels are first seen. A label with no entry in *symbols*,
+    or any label if there is no symbol table, is a Unicode code point,
+    except for the labels Pynini generates for bracketed tokens. Get one
+    with :func:`labelDecoder`, which shares tables between machines. """
+
+    def __init__(self, symbols=None):
+        super(LabelDecoder, self).__init__()
+        self.symbols = symbols
+        self[0] = ""
+
+    def __missing__(self, label):
+        if self.symbols is not None and self.symbols.member(label):
+            string = pynini_decode(self.symbols.find(label))
+        elif _generatedSymbols().member(label):
+            string = "[" + _generatedSymbols().find(label) + "]"
+        else:
+            string = six.unichr(label)
+        self[label] = string
+        return string
+
+    def decode(self, labels):
+        """ Convert a sequence of labels to a string. """
+        return "".join([self[label] for label in labels])
+
+_decoders = {}
+
+def labelDecoder(symbols):
+    """ Return the :class:`LabelDecoder` for the symbol table *symbols*,
+    which may be None, building it the first time the table is seen. """
+    key = None if symbols is None else symbols.labeled_checksum()
+    decoder = _decoders.get(key)
+    if decoder is None:
+        decoder = _decoders[key] = LabelDecoder(
+                None if symbols is None else symbols.copy())
+    return decoder
+
+def _generatedSymbols():
+    # Older versions of Pynini keep bracketed tokens in each machine's own
+    # symbol table instead.
+    generated = getattr(pynini, "generated_symbols", None)
+    return generated() if generated is not None else _noSymbols
+
+class _NoSymbols(object):
+    def member(self, label):
+        return False
+
+_noSymbols = _NoSymbols()
 
 
 def pynini_decode(inputBytes):
     """ Pynini often outputs bytestrings with unprintable characters
     represented in an unusual way. Run them through this to get plain unicode.
     """
-    asString = inputBytes.decode("utf8")
+    asString = (inputBytes.decode("utf8")
+                if isinstance(inputBytes, bytes) else inputBytes)
     asTokens = (from_att_symbol(symbol) for symbol in asString.split(' '))
     return "".join(asTokens)
 
+ATT_SYMBOLS = {
+    "NUL": chr(0),  "":    chr(0),  "epsilon": chr(0),
+    "SOH": chr(1),  "STX": chr(2),  "ETX": chr(3),  "EOT": chr(4),
+    "ENQ": chr(5),  "ACK": chr(6),  "BEL": chr(7),  "BS":  chr(8),
+    "HT":  chr(9),  "LF":  chr(10), "VT":  chr(11), "FF":  chr(12),
+    "CR":  chr(13), "SO":  chr(14), "SI":  chr(15), "DLE": chr(16),
+    "DC1": chr(17), "DC2": chr(18), "DC3": chr(19), "DC4": chr(20),
+    "NAK": chr(21), "SYN": chr(22), "ETB": chr(23), "CAN": chr(24),
+    "EM":  chr(25), "SUB": chr(26), "ESC": chr(27), "FS":  chr(28),
+    "GS":  chr(29), "RS":  chr(30), "US":  chr(31), "SPACE": chr(32),
+    "DEL": chr(127)
+}
+
 def from_att_symbol(string):
     """ OpenFST outputs symbol table representations in an awkward
     format. Attempt to deal with that gracefully. """
@@ -266,18 +903,7 @@ def from_att_symbol(string):
     if string.startswith("<0"):
         return six.unichr(int(string.strip('<>'), 16))
     if string.startswith("<") and string.endswith(">"):
-        return {
-            "NUL": chr(0),  "":    chr(0),  "epsilon": chr(0),
-            "SOH": chr(1),  "STX": chr(2),  "ETX": chr(3),  "EOT": chr(4),
-            "ENQ": chr(5),  "ACK": chr(6),  "BEL": chr(7),  "BS":  chr(8),
-            "HT":  chr(9),  "LF":  chr(10), "VT":  chr(11), "FF":  chr(12),
-            "CR":  chr(13), "SO":  chr(14), "SI":  chr(15), "DLE": chr(16),
-            "DC1": chr(17), "DC2": chr(18), "DC3": chr(19), "DC4": chr(20),
-            "NAK": chr(21), "SYN": chr(22), "ETB": chr(23), "CAN": chr(24),
-            "EM":  chr(25), "SUB": chr(26), "ESC": chr(27), "FS":  chr(28),
-            "GS":  chr(29), "RS":  chr(30), "US":  chr(31), "SPACE": chr(32),
-            "DEL": chr(127)
-        }[string.strip('<>')]
+        return ATT_SYMBOLS[string.strip('<>')]
     if len(string) > 1:
         return "[" + string + "]"
     if string == "[":
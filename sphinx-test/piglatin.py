@@ -1,5 +1,9 @@
+import os
 import re
 from fsmcontainers.fsmcontainers import fsa, fst
+from fsmcontainers.cache import compiled, file_input
+
+WORDS = os.environ.get("PIGLATIN_WORDS", "/usr/share/dict/words")
 
 vowel = fsa("a e i o u".split())
 consonant = fsa("b c d f g h j k l m n p q r s t v w x y z".split())
@@ -7,10 +11,6 @@ punctuation = fsa("- . , ! ? ' \"".split())
 character = vowel | consonant | punctuation
 
 onset_re = re.compile("[^aeiouy]+(?=[aeiouy])")
-with open("/usr/share/dict/words") as f:
-    matches = (onset_re.match(word.lower()) for word in f.readlines())
-    onset = fsa(match.group() for match in matches if match is not None)
-print(onset)
 
 def onset_matcher(s):
     return fsa(s) + (vowel|fsa("y")) + character.star()
@@ -24,21 +24,35 @@ def prefix_deleter(s):
 def pig_latinizer(s):
     return onset_matcher(s) @ suffixer(f'-{s}ay') @ prefix_deleter(s)
 
-piglatin = fst().union(pig_latinizer(o) for o in onset) # This oughta be a classmethod
+@compiled(file_input(WORDS), onset_re.pattern,
+          vowel, consonant, punctuation, character,
+          onset_matcher, suffixer, prefix_deleter, pig_latinizer)
+def build_piglatin(words):
+    # Cached on disk: this only runs again if the word list, this function,
+    # one of the helpers above or one of the machines they use changes.
+    with open(words) as f:
+        matches = (onset_re.match(word.lower()) for word in f.readlines())
+        onset = fsa(match.group() for match in matches if match is not None)
+    print(onset)
+
+    piglatin = fst().union(pig_latinizer(o) for o in onset) # This oughta be a classmethod
+
+    piglatin >>= onset_matcher(fsa("y") + vowel) @ suffixer('-yay') @ prefix_deleter('y')  # HACKY TO CALL FSA HERE
 
-piglatin >>= onset_matcher(fsa("y") + vowel) @ suffixer('-yay') @ prefix_deleter('y')  # HACKY TO CALL FSA HERE
+    piglatin >>= suffixer('-way')
 
-piglatin >>= suffixer('-way')
+    capitals = "A B C D E F G H I J K L M N O P Q R S T U V W X Y Z".split()
+    lowercase = "a b c d e f g h i j k l m n o p q r s t u v w x y z".split()
+    downcase = fst(zip(capitals, lowercase)) + character.star()
+    upcase = fst(zip(lowercase, capitals)) + character.star()
 
-capitals = "A B C D E F G H I J K L M N O P Q R S T U V W X Y Z".split()
-lowercase = "a b c d e f g h i j k l m n o p q r s t u v w x y z".split()
-downcase = fst(zip(capitals, lowercase)) + character.star()
-upcase = fst(zip(lowercase, capitals)) + character.star()
+    piglatin >>= downcase @ piglatin @ upcase
 
-piglatin >>= downcase @ piglatin @ upcase
+    piglatin += fst(punctuation).star()
+    piglatin += (fsa(" ") + piglatin).star()
+    return piglatin
 
-piglatin += fst(punctuation).star()
-piglatin += (fsa(" ") + piglatin).star()
+piglatin = build_piglatin(WORDS)
 
 print(piglatin["Do you speak Pig Latin?"])
 print(piglatin["Street sprint scrap throat knob schmuck schwa chrome phlegm thwack quit"])